@@ -17,20 +17,54 @@ from django.db import models
 from rapidsms.messages.incoming import OutgoingMessage
 from rapidsms.models import ConnectionBase, Contact
 
+from .segments import count_segments
+
 # need to rename the old method to avoid recursive calls    
 OutgoingMessage._text = OutgoingMessage.text
 
 def text(self, *args, **kwargs):
     """
-        Remove unicode conversion from the method
+        Remove unicode conversion from the method, and render the text once:
+        it's cached until a part is appended.
     """
     try:
-        return OutgoingMessage._text.fget(self, *args, **kwargs)
+        return self._rendered_text
+    except AttributeError:
+        pass
+    try:
+        rendered = OutgoingMessage._text.fget(self, *args, **kwargs)
     except UnicodeDecodeError:
-        return " ".join(self._render_part(tmpl, **kwargs) for tmpl, kwargs in self._parts)
+        rendered = " ".join(self._render_part(tmpl, **kwargs) for tmpl, kwargs in self._parts)
+    self._rendered_text = rendered
+    return rendered
 
 OutgoingMessage.text = property(update_wrapper(text, OutgoingMessage._text.fget))
 
+OutgoingMessage._append = OutgoingMessage.append
+
+def append(self, *args, **kwargs):
+    """
+        Drop the cached text and segments
+    """
+    self.__dict__.pop('_rendered_text', None)
+    self.__dict__.pop('_segments', None)
+    return OutgoingMessage._append(self, *args, **kwargs)
+
+OutgoingMessage.append = update_wrapper(append, OutgoingMessage._append)
+
+def segments(self):
+    """
+        A tuple (encoding, number of SMS) for the text, see 
+        segments.count_segments()
+    """
+    try:
+        return self._segments
+    except AttributeError:
+        self._segments = count_segments(self.text)
+        return self._segments
+
+OutgoingMessage.segments = property(segments)
+
 OutgoingMessage.render_part = OutgoingMessage._render_part
 
 def _render_part(self, template, **kwargs):
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Coroutine dispatch, for gateways running the router in an event loop.
+
+    This app runs on Python 2, so it uses trollius, the port of asyncio to
+    Python 2: coroutines are generators decorated with @coroutine, using
+    "yield From(...)" and "raise Return(...)". handle(), help() and match()
+    can be either regular methods or such coroutines.
+
+    Django activates translations per thread, and all the tasks of an event
+    loop share one thread. So the language of a message is activated each
+    time its coroutine is resumed, and deactivated each time it is
+    suspended: concurrent messages in different languages don't mix up
+    their translations. This applies to the coroutines it waits for with
+    "yield From(...)" too, however deeply nested.
+
+    For the same reason, the contact language is never changed here, even
+    for handlers with AUTO_SET_LANG: other coroutines handling messages
+    from the same contact would see it while this one is suspended. The
+    language of the keyword is only passed to the handler as lang_code, as
+    when messages are handled by the pool (see pool.py).
+"""
+
+import sys
+import logging
+from types import GeneratorType
+
+import trollius as asyncio
+from trollius import From, Return
+
+from django.utils import translation
+
+from .exceptions import ExitHandle
+from .context import get_context, switch_language
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+@asyncio.coroutine
+def in_language(lang_code, coro):
+    """
+        Run the coroutine with lang_code activated each time it resumes.
+        The coroutines it waits for run in a task of their own, so they
+        are wrapped too.
+    """
+
+    value, error = None, None
+    while True:
+        django_lang_bak = switch_language(lang_code)
+        try:
+            if error is None:
+                future = coro.send(value)
+            else:
+                future = coro.throw(*error)
+        except StopIteration as stop:
+            # trollius logs an error for the Return never marked as raised
+            stop.raised = True
+            raise Return(getattr(stop, 'value', None))
+        finally:
+            switch_language(django_lang_bak)
+
+        if asyncio.iscoroutine(future):
+            future = in_language(lang_code, future)
+
+        value, error = None, None
+        try:
+            value = yield From(future)
+        except Exception:
+            error = sys.exc_info()
+
+
+@asyncio.coroutine
+def call_in_language(lang_code, func, *args, **kwargs):
+    """
+        Call func(*args, **kwargs) with lang_code activated and wait for the
+        result if it's a coroutine or a future.
+    """
+
+    django_lang_bak = switch_language(lang_code)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        switch_language(django_lang_bak)
+
+    if asyncio.iscoroutine(result):
+        result = yield From(in_language(lang_code, result))
+    elif isinstance(result, asyncio.Future):
+        result = yield From(result)
+
+    raise Return(result)
+
+
+@asyncio.coroutine
+def ignore():
+    """
+        A coroutine for handlers which don't accept the message.
+    """
+    return False
+
+
+@asyncio.coroutine
+def dispatch(handler, router, msg):
+    """
+        Coroutine version of BaseHandler.dispatch(): call the synchronous
+        dispatch() and wait for its result if needed.
+    """
+
+    result = handler.dispatch(router, msg)
+    if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+        result = yield From(result)
+    raise Return(result)
+
+
+@asyncio.coroutine
+def would_handle(handler, msg):
+    """
+        Coroutine version of BaseHandler.would_handle().
+    """
+
+    result = handler.would_handle(msg)
+    if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+        result = yield From(result)
+    raise Return(result)
+
+
+@asyncio.coroutine
+def would_handle_callback(handler, msg):
+    """
+        Coroutine version of CallbackHandler.would_handle().
+    """
+
+    if handler.filtered_out(msg):
+        raise Return(False)
+
+    contact = get_context(msg).contact
+    lang_code = contact.language if contact else translation.get_language()
+
+    try:
+        with metrics.timed(handler, 'match'):
+            match = yield From(call_in_language(lang_code, handler.match, msg))
+    except ExitHandle as exit:
+        raise Return(not exit.carry_on)
+
+    raise Return(bool(match))
+
+
+@asyncio.coroutine
+def dispatch_keyword(handler, router, msg, keyword, lang_code, text):
+    """
+        Coroutine version of KeywordHandler.dispatch_keyword().
+    """
+
+    context = get_context(msg)
+    contact = context.contact
+    active_lang = handler.dispatch_language(contact, lang_code)
+
+    inst = handler(router, msg)
+    ret = None
+    try:
+        if text:
+            if handler._args_spec is not None:
+                yield From(call_in_language(active_lang, 
+                                            handler._args_spec.check,
+                                            text.split()))
+            kwargs = {}
+            if handler._args_parser is not None:
+                kwargs = yield From(call_in_language(active_lang,
+                                                     handler._args_parser.parse,
+                                                     text))
+            with metrics.timed(handler, 'handle'):
+                ret = yield From(call_in_language(active_lang, inst.handle,
+                                                  text, keyword, lang_code,
+                                                  **kwargs))
+        else:
+            with metrics.timed(handler, 'help'):
+                ret = yield From(call_in_language(active_lang, inst.help,
+                                                  keyword, lang_code))
+
+    except ExitHandle as exit:
+
+        if exit.message:
+            inst.respond(exit.message)
+        raise Return(not exit.carry_on)
+
+    except Exception:
+        metrics.count(handler, 'error')
+        get_context(msg).failed = True
+        logger.exception("Error while handling %r with %s",
+                         msg.text, handler.__name__)
+
+    raise Return(ret if ret is not None else True)
+
+
+@asyncio.coroutine
+def dispatch_callback(handler, router, msg):
+    """
+        Coroutine version of CallbackHandler.dispatch().
+    """
+
+    if handler.filtered_out(msg):
+        raise Return(False)
+
+    contact = get_context(msg).contact
+    lang_code = contact.language if contact else translation.get_language()
+
+    inst = handler(router, msg)
+    ret = None
+    try:
+        with metrics.timed(handler, 'match'):
+            match = yield From(call_in_language(lang_code, handler.match, msg))
+        if not match:
+            raise Return(False)
+
+        with metrics.timed(handler, 'handle'):
+            ret = yield From(call_in_language(lang_code, inst.handle, match))
+
+    except ExitHandle as exit:
+
+        if exit.message:
+            inst.respond(exit.message)
+        raise Return(not exit.carry_on)
+
+    except Return:
+        raise
+
+    except Exception:
+        metrics.count(handler, 'error')
+        get_context(msg).failed = True
+        logger.exception("Error while handling %r with %s",
+                         msg.text, handler.__name__)
+
+    raise Return(ret if ret is not None else True)
+
+
+@asyncio.coroutine
+def run_steps(steps):
+    """
+        Coroutine version of App.run_steps(): the handler methods are called
+        through their coroutine version, e.g. dispatch_async() for
+        dispatch(), if they have one.
+    """
+
+    stack = [steps]
+    value, error = None, None
+    while stack:
+        try:
+            if error is None:
+                step = stack[-1].send(value)
+            else:
+                step = stack[-1].throw(*error)
+        except StopIteration as stop:
+            stack.pop()
+            value, error = (stop.args[0] if stop.args else None), None
+            continue
+        except Exception:
+            stack.pop()
+            if not stack:
+                raise
+            value, error = None, sys.exc_info()
+            continue
+
+        value, error = None, None
+        if isinstance(step, GeneratorType):
+            stack.append(step)
+            continue
+        handler, method, args = step
+        try:
+            method = getattr(handler, method + '_async', None) or \
+                     getattr(handler, method)
+            value = method(*args)
+            if asyncio.iscoroutine(value) or isinstance(value, asyncio.Future):
+                value = yield From(value)
+        except Exception:
+            error = sys.exc_info()
+
+    raise Return(value)
+
+
+@asyncio.coroutine
+def handle(app, msg):
+    """
+        Coroutine version of App.handle().
+    """
+
+    context = get_context(msg)
+    context.concurrent = True
+    accepted = yield From(run_steps(app.handle_steps(context,
+                                                     app.route(context))))
+    raise Return(accepted)
@@ -2,21 +2,234 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 
+import sys
+import time
+import threading
+from types import GeneratorType
+
+from django.utils import translation
+from django.utils.translation import ugettext as _
+
 from rapidsms.apps.base import AppBase
-from .utils import get_handlers
+from rapidsms.conf import settings
+
+from .utils import get_handlers, get_lazy_handlers
+from .context import get_context, switch_language, fold_string
+from .handlers.keyword import KeywordHandler
+from .handlers.pattern import PatternHandler, PatternRegistry
+from .fuzzy import FuzzyIndex
+from .trie import KeywordTrie
+from .scheduler import HandlerScheduler, order_handlers
+from .pool import DispatchPool, connection_key
+from .ratelimit import RateLimiter
+from .dedup import DuplicateFilter
+from . import metrics
+from .settings import MERGE_PATTERN_HANDLERS, LAZY_HANDLERS, \
+                      KEYWORD_FUZZY_DISTANCE, HANDLERS_METRICS, \
+                      HANDLERS_METRICS_FILE, HANDLERS_METRICS_INTERVAL, \
+                      ADAPTIVE_HANDLERS_ORDER, ADAPTIVE_HANDLERS_INTERVAL, \
+                      HANDLERS_WORKERS, KEYWORD_FOLD_ACCENTS, \
+                      KEYWORD_SEPARATORS, DUPLICATE_WINDOW, DUPLICATE_ANSWER, \
+                      DUPLICATE_CACHE_SIZE, RATE_LIMIT
+
+
+MERGE_PATTERN_HANDLERS = getattr(settings, 'MERGE_PATTERN_HANDLERS',
+                                 MERGE_PATTERN_HANDLERS)
+LAZY_HANDLERS = getattr(settings, 'LAZY_HANDLERS', LAZY_HANDLERS)
+KEYWORD_FUZZY_DISTANCE = getattr(settings, 'KEYWORD_FUZZY_DISTANCE',
+                                 KEYWORD_FUZZY_DISTANCE)
+HANDLERS_METRICS = getattr(settings, 'HANDLERS_METRICS', HANDLERS_METRICS)
+HANDLERS_METRICS_FILE = getattr(settings, 'HANDLERS_METRICS_FILE',
+                                HANDLERS_METRICS_FILE)
+HANDLERS_METRICS_INTERVAL = getattr(settings, 'HANDLERS_METRICS_INTERVAL',
+                                    HANDLERS_METRICS_INTERVAL)
+ADAPTIVE_HANDLERS_ORDER = getattr(settings, 'ADAPTIVE_HANDLERS_ORDER',
+                                  ADAPTIVE_HANDLERS_ORDER)
+ADAPTIVE_HANDLERS_INTERVAL = getattr(settings, 'ADAPTIVE_HANDLERS_INTERVAL',
+                                     ADAPTIVE_HANDLERS_INTERVAL)
+HANDLERS_WORKERS = getattr(settings, 'HANDLERS_WORKERS', HANDLERS_WORKERS)
+KEYWORD_FOLD_ACCENTS = getattr(settings, 'KEYWORD_FOLD_ACCENTS',
+                               KEYWORD_FOLD_ACCENTS)
+KEYWORD_SEPARATORS = getattr(settings, 'KEYWORD_SEPARATORS',
+                             KEYWORD_SEPARATORS)
+DUPLICATE_WINDOW = getattr(settings, 'DUPLICATE_WINDOW', DUPLICATE_WINDOW)
+DUPLICATE_ANSWER = getattr(settings, 'DUPLICATE_ANSWER', DUPLICATE_ANSWER)
+DUPLICATE_CACHE_SIZE = getattr(settings, 'DUPLICATE_CACHE_SIZE',
+                               DUPLICATE_CACHE_SIZE)
+RATE_LIMIT = getattr(settings, 'RATE_LIMIT', RATE_LIMIT)
 
 
 class App(AppBase):
 
+    pool = None
+    _pool_lock = threading.Lock()
+
     def start(self):
         """
         Spiders all apps, and registers all available handlers.
         """
 
-        self.handlers = get_handlers()
+        keyword_handlers = None
+        if LAZY_HANDLERS:
+            handlers, keyword_handlers = get_lazy_handlers()
+        else:
+            handlers = get_handlers()
+
+        self.register(handlers, keyword_handlers)
+
+
+    def register(self, handlers, keyword_handlers=None):
+        """
+        Registers these handlers and builds the dispatch indexes. 
+        ``keyword_handlers`` are lazy keyword handlers (see 
+        build_keyword_index).
+        """
+
+        self.handlers = handlers
+
         if len(self.handlers):
             class_names = [cls.__name__ for cls in self.handlers]
             self.info("Registered: %s" % (", ".join(class_names)))
+        if keyword_handlers:
+            class_names = [cls.__name__ for cls, keywords in keyword_handlers]
+            self.info("Registered lazily: %s" % (", ".join(class_names)))
+
+        self._metrics_dump_time = 0
+        if HANDLERS_METRICS:
+            metrics.enable()
+
+        self.duplicates = None
+        if DUPLICATE_WINDOW:
+            self.duplicates = DuplicateFilter(DUPLICATE_WINDOW,
+                                              DUPLICATE_CACHE_SIZE)
+
+        self.rate_limiter = RateLimiter(*RATE_LIMIT) if RATE_LIMIT else None
+        self.handler_limiters = {}
+
+        self.load_translations()
+        self.build_keyword_index(keyword_handlers)
+        self.build_pattern_registry()
+        self.build_scheduler()
+
+
+    def load_translations(self):
+        """
+        Load the gettext catalogs of every language in settings.LANGUAGES,
+        this app ones included, so the first message in each language
+        doesn't have to.
+        """
+
+        django_lang_bak = translation.get_language()
+        try:
+            for lang_code, name in settings.LANGUAGES:
+                translation.activate(lang_code)
+        finally:
+            translation.activate(django_lang_bak)
+
+
+    def build_keyword_index(self, keyword_handlers=None):
+        """
+        Build one mapping between every cleaned keyword and alias of all the
+        registered keyword handlers and a tuple (handler, lang_code), so a
+        keyword message is routed with a single dict lookup.
+
+        Handlers that are not keyword handlers, or keyword handlers
+        overriding dispatch(), end up in self.fallback_handlers and are
+        still called one after the other.
+
+        ``keyword_handlers`` is a list of tuples (handler, keywords) for
+        keyword handlers which are not in self.handlers, such as lazy ones.
+        """
+
+        self.keyword_index = {}
+
+        if keyword_handlers is None:
+            keyword_handlers = []
+            self.fallback_handlers = []
+            for handler in self.handlers:
+                if issubclass(handler, KeywordHandler) and handler.indexable():
+                    keyword_handlers.append((handler,
+                                             handler.indexed_keywords()))
+                else:
+                    self.fallback_handlers.append(handler)
+        else:
+            self.fallback_handlers = list(self.handlers)
+
+        for handler, keywords in keyword_handlers:
+            for keyword, lang_code in keywords.iteritems():
+                if keyword in self.keyword_index:
+                    self.warning("Keyword '%s' of %s is already used by %s" % (
+                                 keyword, handler.__name__,
+                                 self.keyword_index[keyword][0].__name__))
+                    continue
+                self.keyword_index[keyword] = (handler, lang_code)
+
+        # keywords of several words, or followed by other separators than
+        # spaces, can't be found from the first word of the message
+        self.keyword_trie = None
+        if KEYWORD_SEPARATORS or any(len(keyword.split()) > 1
+                                     for keyword in self.keyword_index):
+            self.keyword_trie = KeywordTrie(self.keyword_index,
+                                            KEYWORD_SEPARATORS)
+
+        # keyword without accents: keyword. sorted() puts the keywords
+        # written without accents first.
+        self.folded_index = None
+        if KEYWORD_FOLD_ACCENTS:
+            self.folded_index = {}
+            for keyword in sorted(self.keyword_index):
+                self.folded_index.setdefault(fold_string(keyword), keyword)
+
+        self.fuzzy_index = None
+        if KEYWORD_FUZZY_DISTANCE:
+            self.fuzzy_index = FuzzyIndex(self.folded_index or
+                                          self.keyword_index,
+                                          KEYWORD_FUZZY_DISTANCE)
+
+
+    def build_pattern_registry(self):
+        """
+        If MERGE_PATTERN_HANDLERS is set, merge the patterns of all the
+        fallback pattern handlers into a PatternRegistry, so one regex match
+        finds the handler. Handlers that can't be merged stay in
+        self.fallback_handlers.
+        """
+
+        self.pattern_registry = None
+        if not MERGE_PATTERN_HANDLERS:
+            return
+
+        pattern_handlers = [h for h in self.fallback_handlers
+                              if issubclass(h, PatternHandler)]
+        self.pattern_registry = PatternRegistry(pattern_handlers)
+        merged = set(handler for name, handler in self.pattern_registry.handlers)
+        self.fallback_handlers = [h for h in self.fallback_handlers
+                                    if h not in merged]
+
+
+    def build_scheduler(self):
+        """
+        Sort self.fallback_handlers according to their ``priority`` and
+        ``after`` attributes. If ADAPTIVE_HANDLERS_ORDER is set, they are
+        then reordered by a HandlerScheduler as messages come in.
+        """
+
+        self.fallback_handlers = order_handlers(self.fallback_handlers)
+
+        self.scheduler = None
+        if ADAPTIVE_HANDLERS_ORDER:
+            self.scheduler = HandlerScheduler(self.fallback_handlers,
+                                              ADAPTIVE_HANDLERS_INTERVAL)
+
+
+    def ordered_fallback_handlers(self):
+        """
+        Return the handlers which are not in the keyword index, in the order
+        they must be tried.
+        """
+        if self.scheduler is not None:
+            return self.scheduler.handlers
+        return self.fallback_handlers
 
 
     def handle(self, msg):
@@ -25,10 +238,478 @@ class App(AppBase):
         phase if any of them accept it. The first to accept it will
         block the others, and there's deliberately no way to predict
         the order that they're called in. (This is intended to force
-        handlers to be as reluctant as possible.)
+        handlers to be as reluctant as possible.) Handlers for which the
+        order matters can declare it (see scheduler.py).
+
+        Keyword handlers are looked up in the keyword index first, then the
+        other handlers are tried. The contact, language and first word of
+        the message are resolved once, in a DispatchContext shared by all
+        the handlers.
+
+        If DUPLICATE_WINDOW is set, a message already received from the same
+        connection is not handled again (see replay_duplicate). If the
+        connection sends more messages than RATE_LIMIT, or than the
+        rate_limit of the handler, they are refused (see refuse).
+        Duplicates count in RATE_LIMIT, since they may be answered again.
+        """
+
+        context = get_context(msg)
+        return self.handle_routed(context, self.route(context))
+
+
+    def handle_routed(self, context, route, fallback_lang=None):
+        """
+        Same as handle() for the message of this DispatchContext, already
+        routed: ``route`` is what route() returned for it.
+
+        ``fallback_lang`` is the language to activate while the handlers
+        which are not in the keyword index are tried, when the active one
+        is the language of a group of keyword messages (see handle_batch).
+        """
+        return self.run_steps(self.handle_steps(context, route,
+                                                fallback_lang))
+
+
+    def run_steps(self, steps):
+        """
+        Run one of the *_steps() generators and return its result.
+
+        The steps of the dispatch are generators, so that handle() and
+        handle_async() share them and only differ in the way handlers are
+        called (see aio.run_steps). They yield a tuple (handler, method
+        name, args) for each handler method to call, and are sent back its
+        result, or they yield other steps to run, and are sent back their
+        result. They give their result with ``raise StopIteration(result)``,
+        like trollius coroutines.
+        """
+
+        stack = [steps]
+        value, error = None, None
+        while stack:
+            try:
+                if error is None:
+                    step = stack[-1].send(value)
+                else:
+                    step = stack[-1].throw(*error)
+            except StopIteration as stop:
+                stack.pop()
+                value, error = (stop.args[0] if stop.args else None), None
+                continue
+            except Exception:
+                stack.pop()
+                if not stack:
+                    raise
+                value, error = None, sys.exc_info()
+                continue
+
+            value, error = None, None
+            if isinstance(step, GeneratorType):
+                stack.append(step)
+                continue
+            handler, method, args = step
+            try:
+                value = getattr(handler, method)(*args)
+            except Exception:
+                error = sys.exc_info()
+
+        return value
+
+
+    def handle_steps(self, context, route, fallback_lang=None):
+        """
+        Steps of handle_routed(), see run_steps().
+        """
+
+        msg = context.msg
+
+        # duplicates count too: their responses are sent again
+        if self.rate_limiter is not None and \
+           not self.rate_limiter.take(connection_key(msg)):
+            raise StopIteration(self.refuse(context, self.rate_limiter))
+
+        if self.duplicates is not None:
+            replayed = self.replay_duplicate(context)
+            if replayed is not None:
+                raise StopIteration(replayed)
+
+        accepted = False
+        try:
+            if route is not None:
+                accepted = yield self.route_steps(context, route)
+                if accepted:
+                    raise StopIteration(True)
+
+            if fallback_lang is None:
+                accepted = yield self.fallback_steps(context)
+            else:
+                django_lang_bak = switch_language(fallback_lang)
+                try:
+                    accepted = yield self.fallback_steps(context)
+                finally:
+                    switch_language(django_lang_bak)
+            if accepted or route is not None:
+                raise StopIteration(accepted)
+
+            route = self.lookup_route(context)
+            if route is not None:
+                accepted = yield self.route_steps(context, route)
+            raise StopIteration(accepted)
+
+        finally:
+            # refused messages are handled normally once the limit allows
+            if self.duplicates is not None and not context.refused:
+                self.duplicates.add(context, bool(accepted))
+            if metrics.collector is not None:
+                self.record_metrics(context)
+
+
+    def replay_duplicate(self, context):
+        """
+        If the message of this DispatchContext was already received within
+        DUPLICATE_WINDOW seconds, respond the same responses again, or none
+        if DUPLICATE_ANSWER is False, and return whether it was accepted.
+        Otherwise return None.
+        """
+
+        duplicate = self.duplicates.get(context)
+        if duplicate is None:
+            return None
+
+        accepted, responses = duplicate
+        self.info("Duplicate incoming message from %s" % (
+                  context.msg.connection,))
+        if DUPLICATE_ANSWER:
+            for text in responses:
+                context.msg.respond(text)
+        return accepted
+
+
+    def handler_limiter(self, handler):
+        """
+        Return the RateLimiter for the rate_limit of a handler, or None.
+        Limiters are created on first use, so lazy handlers are not loaded
+        to read it.
         """
-        
-        for handler in self.handlers:
-            if handler.dispatch(self.router, msg):
+
+        try:
+            return self.handler_limiters[handler]
+        except KeyError:
+            rate_limit = getattr(handler, 'rate_limit', None)
+            limiter = RateLimiter(*rate_limit) if rate_limit else None
+            return self.handler_limiters.setdefault(handler, limiter)
+
+
+    def refuse(self, context, limiter):
+        """
+        Refuse the message of this DispatchContext because its connection is
+        over the limit of this RateLimiter. A notice is sent the first time,
+        in the contact language. Return True so other apps ignore it too.
+        """
+
+        msg = context.msg
+        context.refused = True
+        self.info("Too many messages from %s" % (msg.connection,))
+        if limiter.notify(connection_key(msg)):
+            django_lang_bak = switch_language(context.lang_code)
+            try:
+                msg.respond(_(u"You are sending too many messages. Please "
+                              u"wait a few minutes before sending more."))
+            finally:
+                switch_language(django_lang_bak)
+        return True
+
+
+    def route(self, context):
+        """
+        Return a tuple (handler, keyword, lang_code, text) for the keyword
+        handler matching the message of this DispatchContext, or None. text
+        is what follows the keyword, or None.
+
+        If there are keywords of several words or KEYWORD_SEPARATORS, the
+        longest keyword starting the message is looked up in a KeywordTrie.
+
+        Only exact keywords are looked up, see lookup_route() for the others.
+        """
+
+        if self.keyword_trie is not None and context.first_word:
+            match = self.keyword_trie.match(context.msg.text)
+            if match is not None:
+                keyword, text = match
+                handler, lang_code = self.keyword_index[keyword]
+                return handler, keyword, lang_code or context.lang_code, text
+
+        keyword = context.first_word
+        if keyword in self.keyword_index:
+            handler, lang_code = self.keyword_index[keyword]
+            return (handler, keyword, lang_code or context.lang_code,
+                    context.text)
+
+
+    def lookup_route(self, context):
+        """
+        Same as route() for a message which no handler accepted, with the
+        keyword matching its first word with KEYWORD_FOLD_ACCENTS or
+        KEYWORD_FUZZY_DISTANCE. These are only tried last, so a message
+        matched by a pattern or callback handler is not taken by a keyword
+        close to its first word.
+        """
+
+        if context.first_word:
+            keyword = self.lookup_keyword(context.first_word)
+            if keyword is not None:
+                handler, lang_code = self.keyword_index[keyword]
+                return (handler, keyword, lang_code or context.lang_code,
+                        context.text)
+
+
+    def route_steps(self, context, route):
+        """
+        Dispatch the message of this DispatchContext to the keyword handler
+        of this route, unless its connection is over the rate_limit of the
+        handler. The result is whether it was accepted (or refused). See
+        run_steps().
+        """
+
+        msg = context.msg
+        handler, keyword, lang_code, text = route
+        limiter = self.handler_limiter(handler)
+        if limiter is not None and not limiter.take(connection_key(msg)):
+            raise StopIteration(self.refuse(context, limiter))
+        accepted = yield (handler, 'dispatch_keyword',
+                          (self.router, msg, keyword, lang_code, text))
+        self.tried(context, handler, accepted)
+        if accepted:
+            self.info("Incoming message handled by %s" % handler.__name__)
+        raise StopIteration(accepted)
+
+
+    def lookup_keyword(self, word):
+        """
+        Return the keyword matching a word which is not in the keyword index
+        with KEYWORD_FOLD_ACCENTS or KEYWORD_FUZZY_DISTANCE, or None.
+        """
+
+        if self.folded_index is not None:
+            word = fold_string(word)
+            try:
+                return self.folded_index[word]
+            except KeyError:
+                pass
+
+        if self.fuzzy_index is not None:
+            keyword = self.fuzzy_index.lookup(word)
+            if keyword is not None and self.folded_index is not None:
+                keyword = self.folded_index[keyword]
+            return keyword
+
+
+    def handle_fallback(self, msg):
+        """
+        Forwards the *msg* to the handlers which are not in the keyword
+        index. A handler over its rate_limit is skipped, unless it would
+        have handled the message: then the message is refused.
+        """
+        return self.run_steps(self.fallback_steps(get_context(msg)))
+
+
+    def fallback_steps(self, context):
+        """
+        Steps of handle_fallback(), see run_steps().
+        """
+
+        msg = context.msg
+
+        if self.pattern_registry is not None:
+            match = self.pattern_registry.match(msg.text)
+            if match is not None:
+                handler, groups = match
+                limiter = self.handler_limiter(handler)
+                if limiter is not None and \
+                   not limiter.available(connection_key(msg)):
+                    raise StopIteration(self.refuse(context, limiter))
+                accepted = yield (handler, 'dispatch_groups',
+                                  (self.router, msg, groups))
+                self.tried(context, handler, accepted)
+                if accepted:
+                    if limiter is not None:
+                        limiter.take(connection_key(msg))
+                    self.info("Incoming message handled by %s" %
+                              handler.__name__)
+                    raise StopIteration(True)
+
+        for handler in self.ordered_fallback_handlers():
+            limiter = self.handler_limiter(handler)
+            if limiter is not None and \
+               not limiter.available(connection_key(msg)):
+                would_handle = yield (handler, 'would_handle', (msg,))
+                if would_handle:
+                    raise StopIteration(self.refuse(context, limiter))
+                continue
+            accepted = yield (handler, 'dispatch', (self.router, msg))
+            self.tried(context, handler, accepted)
+            if accepted:
+                if limiter is not None:
+                    limiter.take(connection_key(msg))
                 self.info("Incoming message handled by %s" % handler.__name__)
-                return True
+                raise StopIteration(True)
+
+
+    def tried(self, context, handler, accepted):
+        """
+        Count a handler tried for the message of this DispatchContext. A
+        handler which raised an error is not counted as accepting it, even
+        though its dispatch() returned True.
+        """
+
+        context.tried += 1
+        failed = context.failed
+        context.failed = False
+        if self.scheduler is not None:
+            self.scheduler.record(handler, accepted and not failed)
+        # errors are already counted by dispatch()
+        if metrics.collector is not None and not failed:
+            metrics.collector.count(handler, 'accept' if accepted else 'reject')
+            if accepted:
+                metrics.collector.count_sms(handler, sum(
+                    response.segments[1] for response in context.msg.responses))
+
+
+    def record_metrics(self, context):
+        """
+        Record the number of handlers tried for a message, and write the
+        metrics to HANDLERS_METRICS_FILE every HANDLERS_METRICS_INTERVAL
+        seconds.
+        """
+
+        metrics.collector.observe_tried(context.tried)
+
+        if HANDLERS_METRICS_FILE:
+            now = time.time()
+            if now >= self._metrics_dump_time:
+                self._metrics_dump_time = now + HANDLERS_METRICS_INTERVAL
+                metrics.collector.dump(HANDLERS_METRICS_FILE)
+
+
+    def handle_batch(self, messages):
+        """
+        Handle a whole list of messages, e.g. a backlog flushed by a gateway,
+        and return a list of tuples (accepted, responses) in the same order.
+
+        The contacts of all the connections are fetched first, with one
+        query. Messages from the same connection are handled in the order of
+        the list: the n-th message of each connection is handled in the n-th
+        round. Within a round, messages are routed and grouped by keyword
+        handler and language, so each language is activated once per group.
+        The other handlers are tried in the language active before, as in
+        handle(). Each message is then handled as in handle(): a duplicate of a
+        message earlier in the list is answered from the first one.
+        """
+
+        self.prefetch_contacts(messages)
+
+        rounds = []
+        counts = {}
+        for msg in messages:
+            key = connection_key(msg)
+            count = counts.get(key, 0)
+            counts[key] = count + 1
+            if count == len(rounds):
+                rounds.append([])
+            rounds[count].append(msg)
+
+        accepted = {}
+        django_lang_bak = translation.get_language()
+        try:
+            for round_messages in rounds:
+                for key, routed in self.group_routes(round_messages):
+                    # the other handlers run in the language active before
+                    switch_language(key[1] if key is not None
+                                    else django_lang_bak)
+                    for context, route in routed:
+                        accepted[id(context.msg)] = bool(
+                            self.handle_routed(context, route,
+                                               django_lang_bak))
+        finally:
+            switch_language(django_lang_bak)
+
+        return [(accepted[id(msg)], msg.responses) for msg in messages]
+
+
+    def group_routes(self, messages):
+        """
+        Route the messages and group them by keyword handler and language.
+        Return a list of tuples ((handler, language), [(context, route)]),
+        the key being None for the messages without keyword.
+        """
+
+        groups = {}
+        groups_order = []
+        for msg in messages:
+            context = get_context(msg)
+            route = self.route(context)
+            key = None
+            if route is not None:
+                handler, keyword, lang_code, text = route
+                key = (handler, handler.dispatch_language(context.contact,
+                                                          lang_code))
+            if key not in groups:
+                groups[key] = []
+                groups_order.append(key)
+            groups[key].append((context, route))
+
+        return [(key, groups[key]) for key in groups_order]
+
+
+    def prefetch_contacts(self, messages):
+        """
+        Fetch the contacts of the connections of all the messages with a
+        single query.
+        """
+
+        # models can't be loaded until the django ORM is ready.
+        from rapidsms.models import Contact
+
+        connections = [msg.connection for msg in messages
+                       if msg.connection and msg.connection.contact_id]
+        contacts = Contact.objects.in_bulk(
+                       set(conn.contact_id for conn in connections))
+        for conn in connections:
+            conn.contact = contacts.get(conn.contact_id)
+
+
+    def submit(self, msg, callback=None):
+        """
+        Handle the *msg* in one of HANDLERS_WORKERS threads, and call
+        ``callback(msg, accepted)`` once done, from that thread. Messages
+        from the same connection are handled in the order they are
+        submitted. The callback must send the responses, e.g. with
+        ``msg.flush_responses()``.
+
+        Handlers must be thread-safe. The contact language is not changed
+        by keyword handlers in this mode.
+        """
+
+        if self.pool is None:
+            with self._pool_lock:
+                if self.pool is None:
+                    self.pool = DispatchPool(self, HANDLERS_WORKERS)
+        self.pool.submit(msg, callback)
+
+
+    def stop(self):
+        """
+        Wait for the messages passed to submit() to be handled.
+        """
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+
+    def handle_async(self, msg):
+        """
+        Coroutine version of handle(), for routers running in an event
+        loop. Handlers can define handle(), help() and match() as
+        coroutines. It requires trollius.
+        """
+        from .aio import handle
+        return handle(self, msg)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Dispatch benchmark: runs App.handle() over a synthetic corpus of
+    messages, with generated keyword, pattern and callback handlers, and
+    reports messages per second, median and 99th percentile latency, and
+    the net number of objects tracked by the gc per message.
+
+    The router, backends, connections and contacts are in-memory stand-ins
+    (see testing.py), so no database is needed, but Django settings are.
+    Run it from your project::
+
+        python -m handlers_i18n.benchmark --keywords 150 --aliases 3 \\
+                                          --save baseline.json
+
+    then, after a change, compare with the saved baseline::
+
+        python -m handlers_i18n.benchmark --keywords 150 --aliases 3 \\
+                                          --compare baseline.json
+
+    The corpus only depends on the options and the seed, so runs are
+    comparable between versions.
+"""
+
+import gc
+import sys
+import json
+import random
+from optparse import OptionParser
+from timeit import default_timer
+
+from django.conf import settings
+
+from rapidsms.messages import IncomingMessage
+
+from .app import App
+from .handlers.keyword import KeywordHandler
+from .handlers.pattern import PatternHandler
+from .handlers.callback import CallbackHandler
+from .testing import FakeRouter, FakeConnection, FakeContact
+
+
+def make_languages(count):
+    """
+        Return ``count`` language codes, the ones of settings.LANGUAGES
+        first.
+    """
+    codes = [code for code, name in settings.LANGUAGES][:count]
+    codes.extend("x%d" % i for i in xrange(count - len(codes)))
+    return codes
+
+
+# module of the generated handlers, shaped like the ones get_handlers()
+# imports ("<app>.handlers.<module>"), as BaseHandler._logger_name() expects
+HANDLERS_MODULE = "%s.handlers.generated" % __name__.rsplit(".", 1)[0]
+
+
+def make_keyword_handler(index, languages, aliases):
+
+    def help(self, keyword, lang_code):
+        self.respond(u"Help for %s" % keyword)
+
+    def handle(self, text, keyword, lang_code):
+        self.respond(u"You said: %s" % text)
+
+    return type("Keyword%dHandler" % index, (KeywordHandler,), {
+        '__module__': HANDLERS_MODULE,
+        'keyword': "kw%d" % index,
+        'aliases': tuple((code, tuple("kw%d%s%d" % (index, code, j)
+                                      for j in xrange(aliases)))
+                         for code in languages),
+        'help': help,
+        'handle': handle,
+    })
+
+
+def make_pattern_handler(index):
+
+    def handle(self, a, b):
+        self.respond(u"%s+%s" % (a, b))
+
+    return type("Pattern%dHandler" % index, (PatternHandler,), {
+        '__module__': HANDLERS_MODULE,
+        'pattern': r'^p%d (\d+) (\d+)$' % index,
+        'handle': handle,
+    })
+
+
+def make_callback_handler(index):
+
+    prefix = u"cb%d " % index
+
+    def match(cls, msg):
+        return msg.text.startswith(prefix) and msg.text
+
+    def handle(self, match):
+        self.respond(u"Callback %d" % index)
+
+    return type("Callback%dHandler" % index, (CallbackHandler,), {
+        '__module__': HANDLERS_MODULE,
+        'match': classmethod(match),
+        'handle': handle,
+    })
+
+
+def make_corpus(options, handlers, languages):
+    """
+        Return a list of (connection, text). 70% of the messages are for
+        keyword handlers, 10% for pattern handlers, 10% for callback
+        handlers and 10% are not handled.
+    """
+
+    rng = random.Random(options.seed)
+
+    connections = [FakeConnection("%08d" % i, contact=FakeContact(
+                                  language=rng.choice(languages)))
+                   for i in xrange(options.connections)]
+
+    keyword_handlers = [h for h in handlers if issubclass(h, KeywordHandler)]
+    kinds = ['keyword'] * 7 + ['pattern', 'callback', 'unknown']
+
+    corpus = []
+    for i in xrange(options.messages):
+        kind = rng.choice(kinds)
+        if kind == 'keyword' and keyword_handlers:
+            handler = rng.choice(keyword_handlers)
+            keyword = rng.choice(handler.keywords().keys())
+            if rng.random() < 0.1:
+                text = keyword.upper()
+            else:
+                text = u"%s %d %d some data" % (keyword, i, rng.randint(0, 99))
+        elif kind == 'pattern' and options.patterns:
+            text = u"p%d %d %d" % (rng.randrange(options.patterns), i, i)
+        elif kind == 'callback' and options.callbacks:
+            text = u"cb%d %d" % (rng.randrange(options.callbacks), i)
+        else:
+            text = u"unknown message %d" % i
+        corpus.append((rng.choice(connections), text))
+
+    return corpus
+
+
+def run(options):
+    """
+        Run the benchmark and return a dict of the results.
+    """
+
+    languages = make_languages(options.languages)
+
+    # aliases languages must be in settings.LANGUAGES
+    languages_bak = settings.LANGUAGES
+    settings.LANGUAGES = tuple(settings.LANGUAGES) + tuple(
+                         (code, code) for code in languages
+                         if code not in dict(settings.LANGUAGES))
+    try:
+        handlers = [make_keyword_handler(i, languages, options.aliases)
+                    for i in xrange(options.keywords)]
+        handlers.extend(make_pattern_handler(i)
+                        for i in xrange(options.patterns))
+        handlers.extend(make_callback_handler(i)
+                        for i in xrange(options.callbacks))
+
+        app = App(FakeRouter())
+        app.register(handlers)
+
+        corpus = make_corpus(options, handlers, languages)
+
+        # warm up
+        for connection, text in corpus[:options.warmup]:
+            app.handle(IncomingMessage(connection=connection, text=text))
+
+        messages = [IncomingMessage(connection=connection, text=text)
+                    for connection, text in corpus]
+
+        # net change in the number of objects tracked by the gc (containers:
+        # contexts, handler instances, responses...) during dispatch: the
+        # ones allocated minus the ones freed. Strings and numbers are not
+        # tracked.
+        gc.collect()
+        gc.disable()
+        try:
+            objects = gc.get_count()[0]
+            for msg in messages[:options.warmup]:
+                app.handle(msg)
+            objects = gc.get_count()[0] - objects
+        finally:
+            gc.enable()
+
+        messages = [IncomingMessage(connection=connection, text=text)
+                    for connection, text in corpus]
+
+        latencies = []
+        start = default_timer()
+        for msg in messages:
+            before = default_timer()
+            app.handle(msg)
+            latencies.append(default_timer() - before)
+        duration = default_timer() - start
+
+    finally:
+        settings.LANGUAGES = languages_bak
+
+    latencies.sort()
+    return {
+        'messages_per_second': len(messages) / duration,
+        'p50_us': latencies[len(latencies) // 2] * 1e6,
+        'p99_us': latencies[int(len(latencies) * 0.99)] * 1e6,
+        'gc_objects_per_message': float(objects) / max(options.warmup, 1),
+    }
+
+
+# metrics for which a higher value is better
+HIGHER_IS_BETTER = set(['messages_per_second'])
+
+
+def report(results, baseline=None):
+    lines = []
+    for name in sorted(results):
+        line = "%-22s %12.2f" % (name, results[name])
+        if baseline and baseline.get(name):
+            change = (results[name] - baseline[name]) / baseline[name] * 100
+            if not change:
+                verdict = ""
+            elif (change > 0) == (name in HIGHER_IS_BETTER):
+                verdict = "better"
+            else:
+                verdict = "worse"
+            line += "   baseline %12.2f  %+7.1f%% %s" % (baseline[name], change,
+                                                       verdict)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--keywords", type="int", default=150,
+                      help="number of keyword handlers")
+    parser.add_option("--patterns", type="int", default=10,
+                      help="number of pattern handlers")
+    parser.add_option("--callbacks", type="int", default=5,
+                      help="number of callback handlers")
+    parser.add_option("--languages", type="int", default=2,
+                      help="number of languages with aliases")
+    parser.add_option("--aliases", type="int", default=2,
+                      help="number of aliases per language and handler")
+    parser.add_option("--connections", type="int", default=100,
+                      help="number of different senders")
+    parser.add_option("--messages", type="int", default=20000,
+                      help="number of messages to dispatch")
+    parser.add_option("--warmup", type="int", default=1000,
+                      help="number of messages dispatched before measuring")
+    parser.add_option("--seed", type="int", default=0,
+                      help="seed of the corpus generator")
+    parser.add_option("--save", metavar="FILE",
+                      help="save the results as a baseline in FILE")
+    parser.add_option("--compare", metavar="FILE",
+                      help="compare the results with the baseline in FILE")
+    options, args = parser.parse_args(argv)
+    config = dict((name, value) for name, value in vars(options).iteritems()
+                  if name not in ('save', 'compare'))
+
+    results = run(options)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            saved = json.load(f)
+        if saved['options'] != config:
+            print "Warning: the baseline was run with other options: %s" % (
+                  saved['options'])
+        baseline = saved['results']
+
+    print report(results, baseline)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'options': config, 'results': results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+import unicodedata
+
+from django.utils import translation
+
+from rapidsms.conf import settings
+
+
+def clean_string(keyword):
+    """
+        Returns a keyword lowercase with no spaces around it.
+    """
+    return keyword.lower().strip()
+
+
+# letters which don't decompose into a letter and accents
+LIGATURES = {
+    ord(u'\xe6'): u'ae', ord(u'\xc6'): u'ae',
+    ord(u'\u0153'): u'oe', ord(u'\u0152'): u'oe',
+    ord(u'\xdf'): u'ss',
+}
+
+
+def build_folding_table():
+    """
+        Return a unicode.translate() table mapping the latin letters with
+        accents to the lowercase letters without them.
+    """
+    table = {}
+    for code in xrange(0xc0, 0x250):
+        letter = unichr(code)
+        base = u''.join(c for c in unicodedata.normalize('NFKD', letter)
+                        if not unicodedata.combining(c)).lower()
+        if base and base != letter:
+            table[code] = base
+    table.update(LIGATURES)
+    return table
+
+
+FOLDING_TABLE = build_folding_table()
+
+
+def fold_string(keyword):
+    """
+        Returns a keyword without accents nor ligatures, e.g. u'r\xe9sultat'
+        gives u'resultat'. It must already be cleaned.
+    """
+    if not isinstance(keyword, unicode):
+        try:
+            keyword = keyword.decode('utf-8')
+        except UnicodeDecodeError:
+            return keyword
+    return keyword.translate(FOLDING_TABLE)
+
+
+def switch_language(lang_code):
+    """
+        Activate lang_code unless it is already the active language, and
+        return the language that was active before.
+    """
+    current = translation.get_language()
+    if lang_code != current:
+        translation.activate(lang_code)
+    return current
+
+
+class DispatchContext(object):
+    """
+        Everything the handlers need to know about an incoming message,
+        resolved once per message instead of once per handler tried:
+
+        - contact: the contact of the message connection
+        - lang_code: the contact language, or settings.LANGUAGE_CODE
+        - first_word: the first word of the text, cleaned
+        - text: the remaining text, or None
+        - clean_text: the whole text, stripped and lowercase
+        - tried: the number of handlers tried so far
+        - concurrent: whether other threads may handle messages from the
+          same contact (see pool.py), so the contact must not be modified
+        - refused: whether the message was refused because its connection
+          is over a rate limit (see App.refuse)
+        - failed: whether the last handler tried raised an error, which
+          its dispatch() logged
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+
+        connection = msg.connection
+        self.contact = connection.contact if connection else None
+        if self.contact:
+            self.lang_code = self.contact.language or settings.LANGUAGE_CODE
+        else:
+            self.lang_code = settings.LANGUAGE_CODE
+
+        splitted_text = (msg.text or '').split(None, 1) + [None, None]
+        if splitted_text[0] is None:
+            self.first_word = None
+        else:
+            self.first_word = clean_string(splitted_text[0])
+        self.text = splitted_text[1]
+        self.clean_text = clean_string(msg.text or u'')
+        self.tried = 0
+        self.concurrent = False
+        self.refused = False
+        self.failed = False
+
+
+def get_context(msg):
+    """
+        Return the DispatchContext of the message, building it the first
+        time.
+    """
+    try:
+        return msg.dispatch_context
+    except AttributeError:
+        msg.dispatch_context = DispatchContext(msg)
+        return msg.dispatch_context
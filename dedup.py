@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Duplicate incoming messages suppression: gateways resend a message
+    when they don't get a delivery report in time, and it should not be
+    handled twice.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+from .pool import connection_key
+
+
+class DuplicateFilter(object):
+    """
+        Remember the messages handled during the last ``window`` seconds,
+        and the outcome of their handling: whether they were accepted and
+        the text of their responses. It keeps at most ``max_size`` messages,
+        the oldest are forgotten first.
+
+        Messages are identified by their sender and their text, lowercased
+        and with the spaces normalized. The text itself is kept rather than
+        a hash of it: messages whose hashes collide are not duplicates.
+    """
+
+    def __init__(self, window=60, max_size=10000):
+        self.window = window
+        self.max_size = max_size
+        # fingerprint: (expiration time, accepted, responses texts), the
+        # oldest first
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def fingerprint(self, context):
+        return (connection_key(context.msg),
+                u' '.join(context.clean_text.split()))
+
+
+    def get(self, context):
+        """
+            Return a tuple (accepted, responses texts) if the message of
+            this DispatchContext has already been handled, or None.
+        """
+
+        key = self.fingerprint(context)
+        with self._lock:
+            try:
+                expires, accepted, responses = self._items[key]
+            except KeyError:
+                return None
+            if expires < time.time():
+                del self._items[key]
+                return None
+            return accepted, responses
+
+
+    def add(self, context, accepted):
+        """
+            Remember the message of this DispatchContext once handled.
+        """
+
+        key = self.fingerprint(context)
+        responses = tuple(response.text for response in context.msg.responses)
+        now = time.time()
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (now + self.window, accepted, responses)
+
+            # expired items are the oldest ones
+            while self._items:
+                oldest = next(iter(self._items))
+                if self._items[oldest][0] >= now and \
+                   len(self._items) <= self.max_size:
+                    break
+                del self._items[oldest]
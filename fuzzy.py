@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Typo tolerant keyword lookup.
+"""
+
+from itertools import combinations
+
+
+def edit_distance(a, b, max_distance):
+    """
+        Return the edit distance (insertions, deletions, substitutions and
+        transpositions of two adjacent letters) between a and b, or
+        max_distance + 1 if it's more than max_distance.
+    """
+
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous2 = None
+    previous = range(len(b) + 1)
+    for i in xrange(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in xrange(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                             previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] \
+               and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+
+    return min(previous[-1], max_distance + 1)
+
+
+def deletions(word, max_distance):
+    """
+        Return the set of all the strings obtained by removing up to
+        max_distance letters from word.
+    """
+
+    variants = set([word])
+    for count in xrange(1, min(max_distance, len(word)) + 1):
+        for positions in combinations(xrange(len(word)), count):
+            variants.add(''.join(c for i, c in enumerate(word)
+                                 if i not in positions))
+    return variants
+
+
+class FuzzyIndex(object):
+    """
+        Find the closest keyword to a misspelled word, using a deletion
+        neighbourhood index: all the strings obtained by removing up to
+        ``max_distance`` letters of each keyword are precomputed, so a
+        lookup only generates the deletions of the word and checks the few
+        keywords sharing one of them, whatever the number of keywords::
+
+            >>> index = FuzzyIndex(['hello', 'report'], 1)
+            >>> index.lookup('helo')
+            'hello'
+
+        Words and keywords shorter than ``min_length`` are never matched,
+        since short keywords are too close to each other. Longer words than
+        ``max_length`` are ignored to bound the lookup time.
+    """
+
+    def __init__(self, keywords, max_distance=1, min_length=4, max_length=20):
+        self.max_distance = max_distance
+        self.min_length = min_length
+        self.max_length = max_length
+        self.keywords = set()
+        self._index = {}
+
+        for keyword in keywords:
+            if min_length <= len(keyword) <= max_length:
+                self.keywords.add(keyword)
+                for variant in deletions(keyword, max_distance):
+                    self._index.setdefault(variant, set()).add(keyword)
+
+
+    def lookup(self, word):
+        """
+            Return the keyword the closest to word within max_distance, or
+            None. Ties are broken alphabetically.
+        """
+
+        if not self.min_length <= len(word) <= self.max_length:
+            return None
+
+        if word in self.keywords:
+            return word
+
+        candidates = set()
+        for variant in deletions(word, self.max_distance):
+            candidates.update(self._index.get(variant, ()))
+
+        best, best_distance = None, self.max_distance + 1
+        for keyword in sorted(candidates):
+            distance = edit_distance(word, keyword, self.max_distance)
+            if distance < best_distance:
+                best, best_distance = keyword, distance
+
+        return best
@@ -6,6 +6,17 @@ from rapidsms.log.mixin import LoggerMixin
 
 
 class BaseHandler(object, LoggerMixin):
+
+    # where the handler is tried among the handlers which are not keyword
+    # handlers, when the order matters (see scheduler.py): a fixed priority
+    # (highest first), and the names of the handlers to try before it.
+    priority = None
+    after = ()
+
+    # max number of messages handled per connection by this handler, a
+    # tuple (count, seconds), see ratelimit.py.
+    rate_limit = None
+
     def _logger_name(self):
         app_label = self.__module__.split(".")[-3]
         return "app/%s/%s" % (app_label, self.__class__.__name__)
@@ -14,6 +25,33 @@ class BaseHandler(object, LoggerMixin):
     def dispatch(cls, router, msg):
         return False
 
+    @classmethod
+    def dispatch_async(cls, router, msg):
+        """
+        Coroutine version of ``dispatch``, used by ``App.handle_async``.
+        By default, it just waits for ``dispatch``.
+        """
+        from ..aio import dispatch
+        return dispatch(cls, router, msg)
+
+    @classmethod
+    def would_handle(cls, msg):
+        """
+        Return True if ``dispatch`` would accept the message, without
+        handling it. Used for handlers over their ``rate_limit``, which
+        refuse only the messages they would have handled. Handlers which
+        can't tell without handling the message are assumed to accept it.
+        """
+        return True
+
+    @classmethod
+    def would_handle_async(cls, msg):
+        """
+        Coroutine version of ``would_handle``.
+        """
+        from ..aio import would_handle
+        return would_handle(cls, msg)
+
     def __init__(self, router, msg):
         self.router = router
         self.msg = msg
@@ -83,3 +121,22 @@ class BaseHandler(object, LoggerMixin):
         accepted = cls.dispatch(None, msg)
         return [m.text for m in msg.responses]\
             if accepted else False
+
+    @classmethod
+    def test_many(cls, texts, identity=None, language=None):
+        """
+        Same as ``test`` for a list of texts, but with an in-memory
+        connection and contact (see testing.Harness), so no database is
+        needed. ``language`` is the language of the contact. Return a list
+        with the result for each text::
+
+            >>> AlwaysHandler.test_many(['anything', 'else'])
+            [['xxx', 'yyy'], ['xxx', 'yyy']]
+        """
+
+        from ..testing import Harness
+
+        if identity is None:
+            identity = "mock"
+
+        return Harness(cls, identity, language).test_many(texts)
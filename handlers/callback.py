@@ -3,8 +3,7 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 
-import sys
-import traceback
+import logging
 
 from django.utils import translation
 from django.conf import settings
@@ -13,6 +12,48 @@ from base import BaseHandler
 from rapidsms.conf import settings
 
 from ..exceptions import ExitHandle
+from ..context import get_context, switch_language
+from .. import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class Prefilter(object):
+    """
+    Cheap checks on the text of a message, stripped and lowercased (see
+    DispatchContext.clean_text), telling if a callback handler can match it:
+
+        - prefixes: a tuple of strings, the text starts with one of them
+        - min_length, max_length: bounds of the length of the text
+        - chars: a string of all the characters the text can contain
+        - leading_digit: if True, the text starts with a digit
+    """
+
+    def __init__(self, prefixes=(), min_length=None, max_length=None,
+                 chars=None, leading_digit=False):
+        if isinstance(prefixes, basestring):
+            prefixes = (prefixes,)
+        self.prefixes = tuple(p.lower() for p in prefixes)
+        self.min_length = min_length
+        self.max_length = max_length
+        self.chars = chars.lower() if chars else chars
+        self.leading_digit = leading_digit
+
+
+    def accepts(self, text):
+        if self.prefixes and not text.startswith(self.prefixes):
+            return False
+        if self.min_length is not None and len(text) < self.min_length:
+            return False
+        if self.max_length is not None and len(text) > self.max_length:
+            return False
+        if self.chars is not None and text.strip(self.chars):
+            return False
+        if self.leading_digit and not text[:1].isdigit():
+            return False
+        return True
+
 
 class CallbackHandler(BaseHandler):
 
@@ -37,8 +78,20 @@ class CallbackHandler(BaseHandler):
     All other messages are silently ignored (as usual), to allow other
     apps or handlers to catch them.
     
+    If match() is costly, declare what the text of the messages it can
+    match looks like (once stripped and lowercased) with a Prefilter, and
+    match() is not called for the others::
+    
+        >>> class AbcHandler(CallbackHandler):
+        ...    prefilter = Prefilter(prefixes=('i love',), max_length=40)
+    
+    No language is activated and no handler is created for the messages
+    failing these checks.
+    
     """
 
+    prefilter = None
+
     @classmethod
     def match(cls, msg):
         """
@@ -52,9 +105,22 @@ class CallbackHandler(BaseHandler):
         raise NotImplementedError()
 
 
+    @classmethod
+    def filtered_out(cls, msg):
+        """
+            Return True if the message can't match according to the
+            prefilter.
+        """
+        return cls.prefilter is not None and \
+               not cls.prefilter.accepts(get_context(msg).clean_text)
+
+
     @classmethod
     def dispatch(cls, router, msg):
 
+        if cls.filtered_out(msg):
+            return False
+
         # todo make this part something common among all handlers        
         # excute handle
         ret = None
@@ -62,10 +128,11 @@ class CallbackHandler(BaseHandler):
         
             # todo: set the translation in an i18n app.
             # we need to do that before in case we goes out in match()
-            contact = msg.connection.contact
-            django_lang_bak = translation.get_language()
+            contact = get_context(msg).contact
             if contact:
-                translation.activate(contact.language)
+                django_lang_bak = switch_language(contact.language)
+            else:
+                django_lang_bak = translation.get_language()
         
             # spawn an instance of this handler, and stash
             # the low(er)-level router and message object
@@ -73,7 +140,8 @@ class CallbackHandler(BaseHandler):
             
             # filter message
             # match may raise ExitHandle
-            match = cls.match(msg)
+            with metrics.timed(cls, 'match'):
+                match = cls.match(msg)
             if not match:
                 return False
 
@@ -82,26 +150,70 @@ class CallbackHandler(BaseHandler):
             # the original text via self.msg if it really needs it.
             # if we received _just_ the keyword, with
             # no content, some help should be sent back
-            ret = inst.handle(match)
+            with metrics.timed(cls, 'handle'):
+                ret = inst.handle(match)
                 
         except ExitHandle as exit:
         
             if exit.message:
                 inst.respond(exit.message)
-            if not exit.carry_on:
-                return True
+            return not exit.carry_on
                 
-        except Exception as e:
-            err, detail, tb = sys.exc_info()
-            print err, detail
-            traceback.print_tb(tb)
+        except Exception:
+            metrics.count(cls, 'error')
+            get_context(msg).failed = True
+            logger.exception("Error while handling %r with %s",
+                             msg.text, cls.__name__)
             
         # set back language to the original one
         finally:
         
-            translation.activate(django_lang_bak)
+            switch_language(django_lang_bak)
 
         return ret if ret is not None else True
+
+
+    @classmethod
+    def would_handle(cls, msg):
+        """
+            Return True if the message passes the prefilter and match()
+            accepts it, without calling handle().
+        """
+
+        if cls.filtered_out(msg):
+            return False
+
+        contact = get_context(msg).contact
+        if contact:
+            django_lang_bak = switch_language(contact.language)
+        else:
+            django_lang_bak = translation.get_language()
+        try:
+            with metrics.timed(cls, 'match'):
+                return bool(cls.match(msg))
+        except ExitHandle as exit:
+            return not exit.carry_on
+        finally:
+            switch_language(django_lang_bak)
+
+
+    @classmethod
+    def would_handle_async(cls, msg):
+        """
+            Coroutine version of would_handle(). match() can be a coroutine.
+        """
+        from ..aio import would_handle_callback
+        return would_handle_callback(cls, msg)
+
+
+    @classmethod
+    def dispatch_async(cls, router, msg):
+        """
+            Coroutine version of dispatch(). match() and handle() can be
+            coroutines.
+        """
+        from ..aio import dispatch_callback
+        return dispatch_callback(cls, router, msg)
         
         
 
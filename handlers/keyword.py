@@ -3,10 +3,8 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 
-import sys
-import traceback
+import logging
 
-from django.utils import translation
 from django.conf import settings
 
 from base import BaseHandler
@@ -14,6 +12,73 @@ from rapidsms.conf import settings
 from rapidsms.models import Contact
 
 from ..exceptions import ExitHandle
+from ..context import clean_string, fold_string, get_context, \
+                      switch_language
+from ..helpers import ArgsSpec, ArgsParser, Arg
+from .. import metrics
+from ..trie import KeywordTrie
+from ..settings import KEYWORD_FOLD_ACCENTS, KEYWORD_SEPARATORS
+
+
+logger = logging.getLogger(__name__)
+
+
+KEYWORD_FOLD_ACCENTS = getattr(settings, 'KEYWORD_FOLD_ACCENTS',
+                               KEYWORD_FOLD_ACCENTS)
+KEYWORD_SEPARATORS = getattr(settings, 'KEYWORD_SEPARATORS',
+                             KEYWORD_SEPARATORS)
+
+
+class ReadOnlyDict(dict):
+    """
+        A dict which can't be modified once built.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("%s is read-only" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _read_only
+
+
+class KeywordHandlerType(type):
+    """
+        Compile the ``args`` attribute of a KeywordHandler, and build its
+        keywords tables, when the class is created. A bad language code in
+        the aliases fails at import time, and the first message doesn't pay
+        for building the tables.
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(KeywordHandlerType, cls).__init__(name, bases, attrs)
+        args = getattr(cls, 'args', None)
+        cls._args_spec = cls._args_parser = None
+        if isinstance(args, ArgsParser):
+            cls._args_parser = args
+        elif args and all(isinstance(arg, Arg) for arg in args):
+            cls._args_parser = ArgsParser(args)
+        elif args is None or isinstance(args, ArgsSpec):
+            cls._args_spec = args
+        else:
+            cls._args_spec = ArgsSpec(args)
+
+        cls._keywords, cls._duplicate_aliases = cls.build_keywords()
+        cls._indexed_keywords = ReadOnlyDict(
+            (kw, None if kw in cls._duplicate_aliases else lang_code)
+            for kw, lang_code in cls._keywords.iteritems())
+
+        # keywords without accents: the keyword they stand for
+        cls._folded_keywords = ReadOnlyDict()
+        if KEYWORD_FOLD_ACCENTS:
+            cls._folded_keywords = ReadOnlyDict(
+                (fold_string(kw), kw) for kw in sorted(cls._keywords))
+
+        # for keywords of several words or other separators than spaces
+        cls._keyword_trie = None
+        if KEYWORD_SEPARATORS or any(len(kw.split()) > 1
+                                     for kw in cls._keywords):
+            cls._keyword_trie = KeywordTrie(cls._keywords, KEYWORD_SEPARATORS)
+
 
 class KeywordHandler(BaseHandler):
 
@@ -47,18 +112,38 @@ class KeywordHandler(BaseHandler):
     apps or handlers to catch them.
     
     You can choose to set the local automatically or not by setting 
-    AUTO_SET_LANG
+    AUTO_SET_LANG. The contact language is not changed when messages are
+    handled concurrently (see App.submit), only the active language is.
     
-    Keywords are case insensitive and are striped before comparison.
+    You can declare the number of values expected after the keyword with
+    ``args``, using the same slices as helpers.require_args(), e.g.
+    ``args = (2, (4, 7), 9)``, or an ArgsSpec. It is checked before calling
+    ``handle``.
+    
+    ``args`` can also declare each value, with the Arg subclasses of 
+    helpers. They are then converted and passed to ``handle`` as keyword
+    arguments::
+    
+        args = (Lookup('site', Site), Int('quantity'), 
+                Date('date', '%d%m%Y', '/-.', optional=True))
+                
+        def handle(self, text, keyword, lang_code, site, quantity, date):
+            ...
+    
+    Keywords are case insensitive and are striped before comparison. With
+    settings.KEYWORD_FOLD_ACCENTS, they are accent insensitive too.
+    
+    Keywords can have several words, e.g. "stock out". The keyword and the
+    data are separated by spaces, or any of settings.KEYWORD_SEPARATORS.
     
     'Keyword' will be used as the keyword for the default language code.
     
     """
     
     
+    __metaclass__ = KeywordHandlerType
+
     AUTO_SET_LANG = True
-    _duplicate_aliases = {}
-    _keywords_cache = {}
    
     @classmethod
     def flatten_string(cls, s):
@@ -73,7 +158,7 @@ class KeywordHandler(BaseHandler):
         """
             Returns a keyword lowercase with no spaces around it.
         """
-        return keyword.lower().strip()
+        return clean_string(keyword)
 
     
     @classmethod
@@ -81,55 +166,76 @@ class KeywordHandler(BaseHandler):
         """
             Return a mapping between all accepted keywords and a language code.
         """
-        # try to get data from the cache first
+        return cls._keywords
+
+
+    @classmethod
+    def build_keywords(cls):
+        """
+            Return a read-only mapping between all accepted keywords and a
+            language code, and the set of the aliases used for several
+            languages. Raise ValueError if a language is not in
+            settings.LANGUAGES.
+
+            It is called once, when the class is created.
+        """
+
+        languages = dict(settings.LANGUAGES)
+        duplicate_counter = {}
+
         try:
-            return cls._keywords_cache[cls.keyword]
-        except KeyError:
-        
-            languages = dict(settings.LANGUAGES)
-            duplicate_counter = {}
-            
-            try:
-                # default keyword
-                kw = cls.clean_string(cls.keyword)
-                kw_mapping = {kw: settings.LANGUAGE_CODE}
-                
-                if settings.LANGUAGE_CODE not in languages:
-                    msg = u"The language code '%(code)s' in your "\
-                          u" settings.LANGUAGE_CODE is not in settings.LANGUAGES."\
-                          u" Please add it." % {'code': settings.LANGUAGE_CODE}
-                    raise ValueError(msg)    
-                
-            except AttributeError:
-                return {}
-            else:   
-                # add aliases for the same language and other ones
-                try:
-                    for lang_code, aliases_list in cls.aliases:
-                        
-                        if lang_code not in languages:
-                            msg = u"The language code '%(code)s' in your "\
-                                  u" aliases is not in settings.LANGUAGES."\
-                                  u" Please add it." % {'code': lang_code}
-                            raise ValueError(msg)                            
-                    
-                        for alias in aliases_list:
-                            kw = cls.clean_string(alias)
-                            duplicate_counter[kw] = duplicate_counter.get(kw, 0) + 1
-                            kw_mapping[kw] = lang_code
-                            
-                except AttributeError:
-                    pass
-        
-        # create a list for duplicate keywords for which we will never force
-        # the lang 
-        cls._duplicate_aliases[cls.keyword] = set()
-        for kw, count in duplicate_counter.iteritems():
-            if count > 1:
-                 cls._duplicate_aliases[cls.keyword].add(kw)
-        cls._keywords_cache[cls.keyword] = kw_mapping # set the cache
-        
-        return kw_mapping
+            # default keyword
+            kw = cls.clean_string(cls.keyword)
+            kw_mapping = {kw: settings.LANGUAGE_CODE}
+
+            if settings.LANGUAGE_CODE not in languages:
+                msg = u"The language code '%(code)s' in your "\
+                      u" settings.LANGUAGE_CODE is not in settings.LANGUAGES."\
+                      u" Please add it." % {'code': settings.LANGUAGE_CODE}
+                raise ValueError(msg)
+
+        except AttributeError:
+            return ReadOnlyDict(), frozenset()
+
+        # add aliases for the same language and other ones
+        for lang_code, aliases_list in getattr(cls, 'aliases', ()):
+
+            if lang_code not in languages:
+                msg = u"The language code '%(code)s' in your "\
+                      u" aliases is not in settings.LANGUAGES."\
+                      u" Please add it." % {'code': lang_code}
+                raise ValueError(msg)
+
+            for alias in aliases_list:
+                kw = cls.clean_string(alias)
+                duplicate_counter[kw] = duplicate_counter.get(kw, 0) + 1
+                kw_mapping[kw] = lang_code
+
+        # duplicate keywords for which we will never force the lang
+        duplicates = frozenset(kw for kw, count in duplicate_counter.iteritems()
+                               if count > 1)
+
+        return ReadOnlyDict(kw_mapping), duplicates
+
+
+    @classmethod
+    def indexable(cls):
+        """
+            Return True if App can dispatch messages to this handler using 
+            its keyword index, which is not the case if dispatch() is 
+            overridden.
+        """
+        return cls.dispatch.__func__ is KeywordHandler.dispatch.__func__
+
+
+    @classmethod
+    def indexed_keywords(cls):
+        """
+            Return a mapping between all accepted keywords and the language
+            code to use with them. Duplicate aliases are mapped to None since
+            for them we never force the lang: the contact one is used.
+        """
+        return cls._indexed_keywords
 
 
     @classmethod
@@ -139,25 +245,35 @@ class KeywordHandler(BaseHandler):
             keyword and the language code.
         """
         
-        text = msg.text
-        if msg.contact:
-            lang_code = msg.contact.language or settings.LANGUAGE_CODE
-        else:
-            lang_code = settings.LANGUAGE_CODE
+        context = get_context(msg)
+        lang_code = context.lang_code
         keyword = None
 
-        if text:     
-            splitted_text = msg.text.split(None, 1) + [None] 
-            first_word = cls.clean_string(splitted_text.pop(0))
+        if context.first_word and cls._keyword_trie is not None:
+            match = cls._keyword_trie.match(msg.text)
+            if match is not None:
+                keyword, text = match
+                if keyword not in cls._duplicate_aliases:
+                    lang_code = cls._keywords[keyword]
+                return keyword, lang_code, text
+
+        if context.first_word:
+            first_word = context.first_word
+            # the context cleans the first word the default way
+            if cls.clean_string.__func__ is not \
+               KeywordHandler.clean_string.__func__:
+                first_word = cls.clean_string(msg.text.split(None, 1)[0])
             try:
                 keywords = cls.keywords()
-                if first_word not in cls._duplicate_aliases[cls.keyword]:
+                if KEYWORD_FOLD_ACCENTS and first_word not in keywords:
+                    first_word = cls._folded_keywords[fold_string(first_word)]
+                if first_word not in cls._duplicate_aliases:
                     lang_code = keywords[first_word]
-                return (first_word, lang_code, splitted_text.pop(0))
+                return (first_word, lang_code, context.text)
             except KeyError:
                 pass
             
-        return keyword, lang_code, splitted_text.pop(0)
+        return keyword, lang_code, context.text
 
 
     @classmethod
@@ -168,20 +284,84 @@ class KeywordHandler(BaseHandler):
         if not keyword or not lang_code:
             return False
 
+        return cls.dispatch_keyword(router, msg, keyword, lang_code, text)
+
+
+    @classmethod
+    def would_handle(cls, msg):
+        keyword, lang_code, text = cls._match(msg)
+        return bool(keyword and lang_code)
+
+
+    @classmethod
+    def dispatch_async(cls, router, msg):
+
+        # filter message
+        keyword, lang_code, text = cls._match(msg)
+        if not keyword or not lang_code:
+            from ..aio import ignore
+            return ignore()
+
+        return cls.dispatch_keyword_async(router, msg, keyword, lang_code, text)
+
+
+    @classmethod
+    def dispatch_keyword_async(cls, router, msg, keyword, lang_code, text):
+        """
+            Coroutine version of dispatch_keyword(). help() and handle()
+            can be coroutines.
+        """
+        from ..aio import dispatch_keyword
+        return dispatch_keyword(cls, router, msg, keyword, lang_code, text)
+
+
+    @classmethod
+    def dispatch_keyword(cls, router, msg, keyword, lang_code, text):
+        """
+            Run help() or handle() for a message already matched against
+            this handler keywords. This is what App uses once its global
+            keyword index found the handler, so the message is not split
+            and compared again.
+        """
+
         # activate language
-        contact = msg.connection.contact
-        django_lang_bak = translation.get_language()
+        contact = get_context(msg).contact
+        django_lang_bak = switch_language(cls.dispatch_language(contact,
+                                                                lang_code))
+
+        # set back language to the original one
+        try:
+            return cls.handle_keyword(router, msg, keyword, lang_code, text)
+        finally:
+            switch_language(django_lang_bak)
+
+
+    @classmethod
+    def dispatch_language(cls, contact, lang_code):
+        """
+            Return the language to activate while handling a message with
+            the keyword language lang_code.
+        """
+        if contact and not cls.AUTO_SET_LANG:
+            return contact.language
+        return lang_code
+
+
+    @classmethod
+    def handle_keyword(cls, router, msg, keyword, lang_code, text):
+        """
+            Same as dispatch_keyword() but the language returned by
+            dispatch_language() must already be active. App.handle_batch()
+            uses it to activate the language once for several messages.
+        """
+
+        context = get_context(msg)
+        contact = context.contact
         contact_lang_bak = None
-        if contact:
-            if cls.AUTO_SET_LANG:
-                contact_lang_bak = contact.language
-                contact.language = lang_code
-                translation.activate(lang_code)
-            else:
-                translation.activate(contact.language)
-        else:
-            translation.activate(lang_code)
-        
+        if contact and cls.AUTO_SET_LANG and not context.concurrent:
+            contact_lang_bak = contact.language
+            contact.language = lang_code
+
         # excute handle
         ret = None
         try:
@@ -195,29 +375,34 @@ class KeywordHandler(BaseHandler):
             # if we received _just_ the keyword, with
             # no content, some help should be sent back
             if text:
-                ret = inst.handle(text, keyword, lang_code)
+                if cls._args_spec is not None:
+                    cls._args_spec.check(text.split())
+                kwargs = {}
+                if cls._args_parser is not None:
+                    kwargs = cls._args_parser.parse(text)
+                with metrics.timed(cls, 'handle'):
+                    ret = inst.handle(text, keyword, lang_code, **kwargs)
             else:
-                ret = inst.help(keyword, lang_code)
+                with metrics.timed(cls, 'help'):
+                    ret = inst.help(keyword, lang_code)
                 
         except ExitHandle as exit:
         
             if exit.message:
                 inst.respond(exit.message)
-            if not exit.carry_on:
-                return True
+            return not exit.carry_on
                 
-        except Exception as e:
-            err, detail, tb = sys.exc_info()
-            print err, detail
-            traceback.print_tb(tb)
+        except Exception:
+            metrics.count(cls, 'error')
+            context.failed = True
+            logger.exception("Error while handling %r with %s",
+                             msg.text, cls.__name__)
             
-        # set back language to the original one
+        # set back contact language to the original one
         finally:
         
-            if cls.AUTO_SET_LANG:
-                if contact_lang_bak:
-                    contact.language = contact_lang_bak
-                translation.activate(django_lang_bak)
+            if contact_lang_bak:
+                contact.language = contact_lang_bak
 
         return ret if ret is not None else True
         
@@ -4,6 +4,29 @@
 
 import re
 from .base import BaseHandler
+from .. import metrics
+
+
+# patterns using these can't be merged with others: group numbers are shifted
+# and inline flags apply to the whole expression
+UNMERGEABLE_PATTERN = re.compile(r'\\\d|\(\?P|\(\?[aiLmsux]')
+
+# max number of groups in a regexp (sre counts the whole match as one)
+MAX_GROUPS = 99
+
+
+class PatternHandlerType(type):
+    """
+    Compile the pattern of a PatternHandler once, when the class is created,
+    instead of on every dispatch.
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(PatternHandlerType, cls).__init__(name, bases, attrs)
+        if hasattr(cls, "pattern"):
+            cls._compiled_pattern = re.compile(cls.pattern, re.IGNORECASE)
+        else:
+            cls._compiled_pattern = None
 
 
 class PatternHandler(BaseHandler):
@@ -45,10 +68,11 @@ class PatternHandler(BaseHandler):
     other apps or handlers to catch them.
     """
 
+    __metaclass__ = PatternHandlerType
+
     @classmethod
     def _pattern(cls):
-        if hasattr(cls, "pattern"):
-            return re.compile(cls.pattern, re.IGNORECASE)
+        return cls._compiled_pattern
 
     @classmethod
     def dispatch(cls, router, msg):
@@ -61,5 +85,107 @@ class PatternHandler(BaseHandler):
         if match is None:
             return False
 
-        cls(router, msg).handle(*match.groups())
+        return cls.dispatch_groups(router, msg, match.groups())
+
+    @classmethod
+    def would_handle(cls, msg):
+        pattern = cls._pattern()
+        return pattern is not None and msg.text is not None \
+               and pattern.match(msg.text) is not None
+
+    @classmethod
+    def dispatch_groups(cls, router, msg, groups):
+        """
+        Call ``handle`` with the captures of a pattern already matched.
+        """
+        with metrics.timed(cls, 'handle'):
+            cls(router, msg).handle(*groups)
         return True
+
+    @classmethod
+    def mergeable(cls):
+        """
+        Return True if the pattern of this handler can be merged with others
+        in a PatternRegistry.
+        """
+        return cls._compiled_pattern is not None \
+               and cls.dispatch.__func__ is PatternHandler.dispatch.__func__ \
+               and not UNMERGEABLE_PATTERN.search(cls.pattern)
+
+
+class PatternRegistry(object):
+    """
+    Merge the patterns of several PatternHandler into one alternation of
+    named groups, so a single match() call picks the handler and its
+    captures::
+
+        >>> registry = PatternRegistry([SumHandler])
+        >>> registry.match("1 plus 2")
+        (<class 'SumHandler'>, ('1', '2'))
+
+    Alternatives are tried in the order of the handlers, so the first
+    handler matching wins, just like when calling them one after the other.
+    Since a regexp can't have more than MAX_GROUPS groups, the patterns are
+    split into as many regexps as needed, tried one after the other.
+
+    Handlers that can't be merged (see PatternHandler.mergeable) are
+    available in ``unmerged`` and must be dispatched as usual.
+    """
+
+    def __init__(self, handlers):
+        self.handlers = []
+        self.unmerged = []
+        # tuples (regexp, slots), slots mapping the index of the group
+        # wrapping each handler pattern to (handler, start, end)
+        self.regexes = []
+
+        chunk = []
+        groups = 0
+        for handler in handlers:
+            size = handler._compiled_pattern.groups + 1 \
+                   if handler.mergeable() else None
+            if size is None or size > MAX_GROUPS:
+                self.unmerged.append(handler)
+                continue
+            if groups + size > MAX_GROUPS:
+                self._compile(chunk)
+                chunk = []
+                groups = 0
+            name = "_h%d" % len(self.handlers)
+            chunk.append((name, handler))
+            groups += size
+            self.handlers.append((name, handler))
+
+        if chunk:
+            self._compile(chunk)
+
+    def _compile(self, handlers):
+        regex = re.compile("|".join("(?P<%s>%s)" % (name, handler.pattern)
+                                    for name, handler in handlers),
+                           re.IGNORECASE)
+
+        # the wrapping group is the last one to close, so it is the
+        # match lastindex. Captures of the handler follow it.
+        slots = {}
+        for name, handler in handlers:
+            index = regex.groupindex[name]
+            slots[index] = (handler, index,
+                            index + handler._compiled_pattern.groups)
+        self.regexes.append((regex, slots))
+
+    def match(self, text):
+        """
+        Return a tuple (handler, captures) for the first handler matching
+        ``text``, or None.
+        """
+
+        if text is None:
+            return None
+
+        for regex, slots in self.regexes:
+            match = regex.match(text)
+            if match is not None:
+                handler, start, end = slots[match.lastindex]
+                return handler, match.groups()[start:end]
+
+        return None
@@ -2,55 +2,90 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4
 
+import re
+import time
 import datetime
+import threading
+from collections import OrderedDict
 
-from django.utils.translation import ugettext as _
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.utils.translation import ugettext as _, get_language
 
 from handlers_i18n.exceptions import ExitHandle
+from handlers_i18n.settings import LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL
 
-def require_args(args, min=None, max=None, slices=()):
+
+LOOKUP_CACHE_SIZE = getattr(settings, 'LOOKUP_CACHE_SIZE', LOOKUP_CACHE_SIZE)
+LOOKUP_CACHE_TTL = getattr(settings, 'LOOKUP_CACHE_TTL', LOOKUP_CACHE_TTL)
+
+class ArgsSpec(object):
     """
-        Exits if the number of arguments does not match the requirement.
+        The number of arguments a command accepts, compiled once:
+        
+        - min: minimum number of arguments
+        - max: maximum number of arguments
+        - slices: an iterable of items like:
+            - an int
+            - an tuple of boundaries that will be passed to xrange
         
-        Slices expect a iterable of items like:
-        - an int
-        - an tuple of boundaries that will be passed to xrange
+        If the number of arguments matches one item of slices, the test 
+        passes. e.g.:
         
-        If len(args) matches one item of slices, the test passes. e.g.:
+        (2, (4, 7), 9) would pass with 2, 4, 5, 6, 9
         
-        (2, (4, 7), 9) would pass with 2, 4, 5, 6, 7, 9  
+        The error message for slices is rendered once per language.
     """
 
-    count = len(args)
-    if min and count < min:
-        raise ExitHandle(_(u'This command expects at least %(min)s value(s). '\
-                           u'You provided %(args_number)s.') % {
-                           'min': min, 'args_number': count} )
-                           
-    if max and count > max:
-        raise ExitHandle(_(u'This command expects %(max)s value(s) maximum. '\
-                           u'You provided %(args_number)s.') % {
-                           'max': max, 'args_number': count} )
+    def __init__(self, slices=(), min=None, max=None):
+        self.min = min
+        self.max = max
+        self.counts = frozenset()
+        if slices:
+            counts = set()
+            for x in slices:
+                try:
+                    counts.update(xrange(*x))
+                except TypeError:
+                    counts.add(x)
+            self.counts = frozenset(counts)
+        self._messages = {}
+
+
+    def check(self, args):
+        """
+            Exits if the number of arguments does not match the spec.
+        """
+
+        count = len(args)
+        if self.min and count < self.min:
+            raise ExitHandle(_(u'This command expects at least %(min)s value(s). '\
+                               u'You provided %(args_number)s.') % {
+                               'min': self.min, 'args_number': count} )
+                               
+        if self.max and count > self.max:
+            raise ExitHandle(_(u'This command expects %(max)s value(s) maximum. '\
+                               u'You provided %(args_number)s.') % {
+                               'max': self.max, 'args_number': count} )
+
+        if self.counts and count not in self.counts:
+            raise ExitHandle(self._message() % {'args_number': count})
+
+
+    def _message(self):
+        """
+            Return the error message for slices in the active language, 
+            waiting for the number of arguments.
+        """
+
+        lang_code = get_language()
+        try:
+            return self._messages[lang_code]
+        except KeyError:
+            pass
 
-    if slices:
-        # checking the range
-        for x in slices:
-            try:
-                if count in xrange(*x):
-                    return
-            except TypeError:
-                if x == count:
-                    return
-                    
         # building a string for range in error message        
-        args_range = set()
-        for x in slices:
-            try:
-                args_range.update(xrange(*x))
-            except TypeError:
-                args_range.add(x)
-        
-        args_range = sorted(list(str(x) for x in args_range))
+        args_range = [str(x) for x in sorted(self.counts)]
         if len(args_range) > 1:
             args_range = _('%(ranges)s or %(range)s') % {
                           'ranges': ', '.join(args_range[:-1]), 
@@ -58,30 +93,300 @@ def require_args(args, min=None, max=None, slices=()):
         else:
             args_range = args_range.pop()            
         
-        raise ExitHandle(_(u'This command expects %(range)s value(s). You '\
-                          u'provided %(args_number)s.') % {'range': args_range,
-                                                         'args_number': count})
+        message = _(u'This command expects %(range)s value(s). You '\
+                    u'provided %(args_number)s.') % {'range': args_range,
+                                             'args_number': '%(args_number)s'}
+        self._messages[lang_code] = message
+        return message
+
+
+_args_specs = {}
+
+
+def require_args(args, min=None, max=None, slices=()):
+    """
+        Exits if the number of arguments does not match the requirement.
+        
+        See ArgsSpec for min, max and slices.
+    """
+
+    # slices may be given as lists, which can't be used in a key
+    key = (min, max, tuple(tuple(s) if isinstance(s, list) else s
+                           for s in slices))
+    try:
+        spec = _args_specs[key]
+    except KeyError:
+        spec = _args_specs[key] = ArgsSpec(slices, min, max)
+    spec.check(args)
         
 
+# regexps matching the same strings than the strptime() directives
+DATE_DIRECTIVES = {
+    'd': r'(3[01]|[12]\d|0[1-9]|[1-9])',
+    'm': r'(1[0-2]|0[1-9]|[1-9])',
+    'y': r'(\d\d)',
+    'Y': r'(\d\d\d\d)',
+    'H': r'(2[0-3]|[0-1]\d|\d)',
+    'M': r'([0-5]\d|\d)',
+}
+
+DATE_DIRECTIVE = re.compile(r'%(.)')
+
+
+class DateParser(object):
+    """
+        Parse dates written in one of several formats, once the separators 
+        are removed. E.g::
+        
+            >>> parser = DateParser(('%d%m%y', '%d%m%Y'), '/-. ')
+            >>> parser.parse('12/03/10') == parser.parse('12-3-2010')
+            True
+        
+        Formats only made of %d, %m, %y, %Y, %H and %M directives are 
+        compiled to a regexp, which is much faster than strptime(). Other
+        formats fall back on strptime().
+        
+        Formats are tried by order of hits, the most used first. If a date
+        can be read with several formats, set reorder to False so the
+        formats are always tried in the given order.
+    """
+
+    def __init__(self, formats, remove_separators=(), reorder=True):
+        if isinstance(formats, basestring):
+            formats = (formats,)
+        self.formats = tuple(formats)
+        self.remove_separators = ''.join(remove_separators)
+        self.reorder = reorder
+        self._translate_table = dict((ord(c), None) for c in remove_separators)
+        self._parsers = tuple(self._compile(f) for f in self.formats)
+        self._hits = [0] * len(self.formats)
+        self._order = tuple(range(len(self.formats)))
+
+
+    def _compile(self, date_format):
+        """
+            Return a function parsing a date string with this format, or
+            returning None.
+        """
+
+        # the directives become groups, the literal characters between them
+        # must match as is, except whitespace which matches any whitespace
+        # as with strptime()
+        directives = []
+        parts = []
+        start = 0
+        try:
+            for match in DATE_DIRECTIVE.finditer(date_format):
+                parts.append(self._escape(date_format[start:match.start()]))
+                directive = match.group(1)
+                parts.append(DATE_DIRECTIVES[directive])
+                directives.append(directive)
+                start = match.end()
+            parts.append(self._escape(date_format[start:]))
+            regex = re.compile(''.join(parts) + '$', re.IGNORECASE)
+        except KeyError:
+            def parse(date_str):
+                try:
+                    return datetime.datetime.strptime(date_str, date_format)
+                except ValueError:
+                    return None
+            return parse
+
+        # position of each directive in the groups of the regexp
+        position = dict((d, i) for i, d in enumerate(directives)).get
+        Y, y, m, d, H, M = (position(x) for x in 'YymdHM')
+
+        def parse(date_str):
+            match = regex.match(date_str)
+            if match is None:
+                return None
+            groups = match.groups()
+            if Y is not None:
+                year = int(groups[Y])
+            elif y is not None:
+                # same pivot as strptime
+                year = int(groups[y])
+                year += 2000 if year < 69 else 1900
+            else:
+                year = 1900
+            try:
+                return datetime.datetime(year, 
+                                         int(groups[m]) if m is not None else 1,
+                                         int(groups[d]) if d is not None else 1,
+                                         int(groups[H]) if H is not None else 0,
+                                         int(groups[M]) if M is not None else 0)
+            except ValueError:
+                return None
+        return parse
+
+
+    @staticmethod
+    def _escape(literal):
+        return r'\s+'.join(re.escape(part) for part in re.split(r'\s+', literal))
+
+
+    def clean(self, date_str):
+        """
+            Return the date string without the separators.
+        """
+        if isinstance(date_str, unicode):
+            return date_str.translate(self._translate_table)
+        return date_str.translate(None, self.remove_separators)
+
+
+    def parse(self, date_str):
+        """
+            Return a datetime object for this date string. Otherwise, exit 
+            the handle.
+        """
+
+        date_str = self.clean(date_str)
+        for index in self._order:
+            date = self._parsers[index](date_str)
+            if date is not None:
+                if self.reorder:
+                    self._hit(index)
+                return date
+
+        raise ExitHandle(_(u"%(date_str)s is not a valid date. "\
+                           u"The expected date format is: %(format)s") % {
+                           'date_str': date_str, 
+                           'format':_(self.formats[0].replace('%', '')) })
+
+
+    def parse_all(self, date_strs):
+        """
+            Return a list of datetime objects for all these date strings. 
+            Exit the handle for the first invalid one.
+        """
+        return [self.parse(date_str) for date_str in date_strs]
+
+
+    def _hit(self, index):
+        self._hits[index] += 1
+        position = self._order.index(index)
+        if position and self._hits[index] > self._hits[self._order[position - 1]]:
+            order = list(self._order)
+            order[position - 1], order[position] = index, order[position - 1]
+            self._order = tuple(order)
+
+
+_date_parsers = {}
+
+
 def check_date(date_str, date_format, remove_separators=()):
     """
         Check is the date has the right format and return a date object.
         Otherwise, exist the handle.
+        
+        date_format can be a list of formats. See DateParser.
     """
     
-    translate_table = dict((ord(c), None) for c in remove_separators)
-    date_str = date_str.translate(translate_table)
-
+    if not isinstance(date_format, basestring):
+        date_format = tuple(date_format)
+    key = (date_format, tuple(remove_separators))
     try:
-        return datetime.datetime.strptime(date_str, date_format)
-    except ValueError:
-        raise ExitHandle(_(u"%(date_str)s is not a valid date. "\
-                           u"The expected date format is: %(format)s") % {
-                           'date_str': date_str, 
-                           'format':_(date_format.replace('%', '')) })
+        parser = _date_parsers[key]
+    except KeyError:
+        parser = _date_parsers[key] = DateParser(date_format, remove_separators,
+                                                 reorder=False)
+    return parser.parse(date_str)
                                
 
 
+class LookupCache(object):
+    """
+        A thread safe LRU cache for check_exists(), keyed by 
+        (model, field_code, code), which entries expire after ``ttl``
+        seconds. It keeps at most ``max_size`` entries.
+        
+        Entries of a model are dropped whenever an object of this model is
+        saved or deleted.
+    """
+
+    def __init__(self, max_size=LOOKUP_CACHE_SIZE, ttl=LOOKUP_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._models = set()
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        """
+            Return the cached value for this key or raise KeyError.
+        """
+        with self._lock:
+            expires, value = self._items.pop(key)
+            if expires < time.time():
+                raise KeyError(key)
+            self._items[key] = (expires, value)
+            return value
+
+
+    def set(self, key, value):
+        model = key[0]
+        if model not in self._models:
+            self._watch(model)
+
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + self.ttl, value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+    def invalidate(self, model):
+        """
+            Drop all the entries for this model.
+        """
+        with self._lock:
+            for key in [k for k in self._items if k[0] is model]:
+                del self._items[key]
+
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+    def _watch(self, model):
+        def invalidate(sender, **kwargs):
+            self.invalidate(sender)
+        self._models.add(model)
+        dispatch_uid = 'handlers_i18n_lookup_cache_%d_%s' % (id(self), 
+                                                          model.__name__)
+        post_save.connect(invalidate, sender=model, weak=False,
+                          dispatch_uid=dispatch_uid)
+        post_delete.connect(invalidate, sender=model, weak=False,
+                            dispatch_uid=dispatch_uid)
+
+
+# the cache for check_exists(), enabled by setting LOOKUP_CACHE_SIZE
+lookup_cache = LookupCache() if LOOKUP_CACHE_SIZE else None
+
+_verbose_names = {}
+
+
+def _does_not_exist(code, model, field_code):
+    """
+        Return the ExitHandle to raise when no object has this code.
+    """
+
+    try:
+        obj_name, field_name = _verbose_names[(model, field_code)]
+    except KeyError:
+        obj_name = unicode(model._meta.verbose_name)
+        field_name = unicode(model._meta.get_field_by_name(field_code)[0].verbose_name)
+        _verbose_names[(model, field_code)] = (obj_name, field_name)
+
+    return ExitHandle(_(u"No %(obj_name)s with %(field_name)s '%(code)s' "\
+                        u"exists. Ask your administrator the right "\
+                        u"%(field_name)s for your %(obj_name)s.") % {
+                        'obj_name': _(obj_name), 'field_name':_(field_name), 
+                        'code': code})
+
+
 def check_exists(code, model, field_code='code'):
     """
         Exit the handle if the objects does not exists.
@@ -89,17 +394,204 @@ def check_exists(code, model, field_code='code'):
         If it does, returns it.
         
         Code field must have a unique constraint and a verbose name for it to work.
+        
+        If LOOKUP_CACHE_SIZE is set, results are cached in lookup_cache.
     """
     
+    key = (model, field_code, code)
     try:
-        obj = model.objects.get(**{field_code:code})
-    except model.DoesNotExist:
-        obj_name = unicode(model._meta.verbose_name)
-        field_name = unicode(model._meta.get_field_by_name(field_code)[0].verbose_name)
-        raise ExitHandle(_(u"No %(obj_name)s with %(field_name)s '%(code)s' "\
-                           u"exists. Ask your administrator the right "\
-                           u"%(field_name)s for your %(obj_name)s.") % {
-                           'obj_name': _(obj_name), 'field_name':_(field_name), 
-                           'code': code})
+        if lookup_cache is None:
+            raise KeyError(key)
+        obj = lookup_cache.get(key)
+    except KeyError:
+        try:
+            obj = model.objects.get(**{field_code:code})
+        except model.DoesNotExist:
+            obj = None
+        if lookup_cache is not None:
+            lookup_cache.set(key, obj)
+
+    if obj is None:
+        raise _does_not_exist(code, model, field_code)
                                
     return obj                 
+
+
+def check_all_exist(codes, model, field_code='code'):
+    """
+        Same as check_exists() for several codes of the same model, e.g. 
+        all the product codes of one SMS, with a single query for all the
+        codes which are not in lookup_cache.
+        
+        Returns the objects in the order of the codes. Exit the handle for
+        the first code which doesn't exist.
+    """
+
+    found = {}
+    missing = set()
+    for code in codes:
+        try:
+            if lookup_cache is None:
+                raise KeyError(code)
+            found[code] = lookup_cache.get((model, field_code, code))
+        except KeyError:
+            missing.add(code)
+
+    if missing:
+        # codes may not have the type of the field, e.g. for integers
+        to_python = model._meta.get_field(field_code).to_python
+        objects = dict((getattr(obj, field_code), obj) for obj in 
+                       model.objects.filter(**{field_code + '__in': missing}))
+        for code in missing:
+            obj = objects.get(to_python(code))
+            if obj is None and objects:
+                # the database may match codes differently, e.g. 'foo' and
+                # 'Foo' with a case insensitive collation: let it decide
+                try:
+                    obj = model.objects.get(**{field_code: code})
+                except model.DoesNotExist:
+                    pass
+            found[code] = obj
+            if lookup_cache is not None:
+                lookup_cache.set((model, field_code, code), found[code])
+
+    objects = []
+    for code in codes:
+        if found[code] is None:
+            raise _does_not_exist(code, model, field_code)
+        objects.append(found[code])
+
+    return objects
+
+
+class Arg(object):
+    """
+        An argument of a command, for ArgsParser. Subclasses convert the
+        value typed in the SMS in convert(), and exit the handle if it's
+        not valid.
+
+        - name: the name of the keyword argument passed to handle()
+        - optional: the argument may be missing, it's then None. Only the
+          last arguments can be optional.
+        - rest: the argument is all the remaining text, spaces included.
+          Only the last argument can be.
+    """
+
+    def __init__(self, name, optional=False, rest=False):
+        self.name = name
+        self.optional = optional
+        self.rest = rest
+
+
+    def convert(self, value):
+        return value
+
+
+class Int(Arg):
+
+    def convert(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            raise ExitHandle(_(u"%(value)s is not a valid number.") % {
+                               'value': value})
+
+
+class Date(Arg):
+    """
+        A date in one of the formats, see DateParser.
+    """
+
+    def __init__(self, name, formats, remove_separators=(), **kwargs):
+        super(Date, self).__init__(name, **kwargs)
+        self.parser = DateParser(formats, remove_separators, reorder=False)
+
+
+    def convert(self, value):
+        return self.parser.parse(value)
+
+
+class Lookup(Arg):
+    """
+        The object of the model which ``field_code`` is the value, see 
+        check_exists(). The objects of all the Lookup arguments of a model
+        are fetched with one query.
+    """
+
+    def __init__(self, name, model, field_code='code', **kwargs):
+        super(Lookup, self).__init__(name, **kwargs)
+        self.model = model
+        self.field_code = field_code
+
+
+class ArgsParser(object):
+    """
+        Split the text following a keyword, and convert each value with the
+        Arg declared for its position::
+
+            >>> parser = ArgsParser((Lookup('site', Site), Int('quantity'),
+            ...                      Arg('comment', optional=True, rest=True)))
+            >>> parser.parse(u'kbl 12 out of stock')
+            {'site': <Site: Kabul>, 'quantity': 12, 'comment': u'out of stock'}
+
+        The number of values is checked with an ArgsSpec, so the messages
+        are the same than require_args() ones.
+    """
+
+    def __init__(self, args):
+        self.args = tuple(args)
+
+        optional = False
+        for i, arg in enumerate(self.args):
+            if arg.optional:
+                optional = True
+            elif optional:
+                raise ValueError(u"The argument '%s' can't follow optional "
+                                 u"arguments." % arg.name)
+            if arg.rest and i != len(self.args) - 1:
+                raise ValueError(u"Only the last argument can take the rest "
+                                 u"of the text, not '%s'." % arg.name)
+
+        self.rest = bool(self.args) and self.args[-1].rest
+        self.spec = ArgsSpec(min=len([a for a in self.args if not a.optional]),
+                             max=None if self.rest else len(self.args))
+
+        # lookups grouped by model, to fetch them with one query
+        self.lookups = {}
+        for i, arg in enumerate(self.args):
+            if isinstance(arg, Lookup):
+                key = (arg.model, arg.field_code)
+                self.lookups.setdefault(key, []).append(i)
+        self.converted = tuple((i, arg) for i, arg in enumerate(self.args)
+                               if not isinstance(arg, Lookup))
+
+
+    def parse(self, text):
+        """
+            Return a dict mapping the name of each argument to its value.
+            Exit the handle if there are not enough or too many values, or
+            if a value is not valid.
+        """
+
+        if self.rest:
+            values = text.split(None, len(self.args) - 1)
+        else:
+            values = text.split()
+        self.spec.check(values)
+
+        result = dict.fromkeys(arg.name for arg in self.args)
+        count = len(values)
+
+        for (model, field_code), positions in self.lookups.iteritems():
+            positions = [i for i in positions if i < count]
+            if positions:
+                objects = check_all_exist([values[i] for i in positions],
+                                          model, field_code)
+                for i, obj in zip(positions, objects):
+                    result[self.args[i].name] = obj
+
+        for i, arg in self.converted:
+            if i < count:
+                result[arg.name] = arg.convert(values[i])
+
+        return result
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Dispatch instrumentation: how many messages each handler accepts,
+    rejects or fails on, how long match(), handle() and help() take, how
+    many handlers are tried for each message, and how many SMS the
+    responses of each handler cost.
+
+    It is disabled unless HANDLERS_METRICS is set: ``collector`` is then
+    None and the instrumentation points do nothing.
+"""
+
+import os
+import bisect
+import tempfile
+import threading
+from timeit import default_timer
+
+
+# upper bounds of the latency histograms buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+# upper bounds of the handlers tried per message histogram buckets
+TRIED_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+            Return a list of tuples (upper bound, count of values lower or
+            equal), the last bound being '+Inf'.
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics(object):
+    """
+        Counters and histograms of the dispatch, by handler name.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.sms = {}
+        self.latencies = {}
+        self.tried = Histogram(TRIED_BUCKETS)
+        self._lock = threading.Lock()
+
+
+    def count(self, handler, outcome):
+        """
+            Count an outcome ('accept', 'reject' or 'error') for a handler.
+        """
+        key = (handler.__name__, outcome)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+
+    def count_sms(self, handler, count):
+        """
+            Count the SMS sent in response by a handler.
+        """
+        name = handler.__name__
+        with self._lock:
+            self.sms[name] = self.sms.get(name, 0) + count
+
+
+    def observe(self, handler, method, seconds):
+        """
+            Record the time a handler method ('match', 'handle' or 'help')
+            took.
+        """
+        key = (handler.__name__, method)
+        with self._lock:
+            try:
+                histogram = self.latencies[key]
+            except KeyError:
+                histogram = self.latencies[key] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+
+    def observe_tried(self, count):
+        """
+            Record the number of handlers tried for a message.
+        """
+        with self._lock:
+            self.tried.observe(count)
+
+
+    def render(self):
+        """
+            Return the metrics in the Prometheus text format.
+        """
+
+        lines = ['# TYPE handlers_i18n_dispatch_total counter']
+        with self._lock:
+            for (name, outcome), value in sorted(self.counters.iteritems()):
+                lines.append('handlers_i18n_dispatch_total'
+                             '{handler="%s",outcome="%s"} %d' % (
+                             name, outcome, value))
+
+            lines.append('# TYPE handlers_i18n_sms_total counter')
+            for name, value in sorted(self.sms.iteritems()):
+                lines.append('handlers_i18n_sms_total{handler="%s"} %d' % (
+                             name, value))
+
+            lines.append('# TYPE handlers_i18n_latency_seconds histogram')
+            for (name, method), histogram in sorted(self.latencies.iteritems()):
+                labels = 'handler="%s",method="%s"' % (name, method)
+                lines.extend(self._render_histogram(
+                             'handlers_i18n_latency_seconds', labels,
+                             histogram))
+
+            lines.append('# TYPE handlers_i18n_tried_handlers histogram')
+            lines.extend(self._render_histogram(
+                         'handlers_i18n_tried_handlers', '', self.tried))
+
+        return '\n'.join(lines) + '\n'
+
+
+    def _render_histogram(self, metric, labels, histogram):
+        separator = ',' if labels else ''
+        lines = ['%s_bucket{%s%sle="%s"} %d' % (metric, labels, separator,
+                                                  bound, count)
+                 for bound, count in histogram.cumulative()]
+        labels = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %s' % (metric, labels, histogram.sum))
+        lines.append('%s_count%s %d' % (metric, labels, histogram.count))
+        return lines
+
+
+    def dump(self, path):
+        """
+            Write the metrics to a text file, e.g. for the node exporter
+            textfile collector.
+        """
+        # several processes may dump at once: each writes its own
+        # temporary file, and renaming it is atomic
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+
+class Timer(object):
+
+    def __init__(self, handler, method):
+        self.handler = handler
+        self.method = method
+
+    def __enter__(self):
+        self.start = default_timer()
+
+    def __exit__(self, *exc_info):
+        collector.observe(self.handler, self.method,
+                          default_timer() - self.start)
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+# the Metrics of the app, if enabled
+collector = None
+
+
+def enable():
+    """
+        Start collecting metrics, and return the Metrics object.
+    """
+    global collector
+    if collector is None:
+        collector = Metrics()
+    return collector
+
+
+def disable():
+    global collector
+    collector = None
+
+
+def timed(handler, method):
+    """
+        Return a context manager recording the time spent in the method of
+        a handler, if metrics are enabled.
+    """
+    if collector is None:
+        return NULL_TIMER
+    return Timer(handler, method)
+
+
+def count(handler, outcome):
+    if collector is not None:
+        collector.count(handler, outcome)
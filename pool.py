@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Concurrent dispatch: messages are handled by a pool of threads, so
+    handlers blocking on I/O (database, HTTP...) don't hold the others.
+
+    Messages from the same connection are handled one at a time, in the
+    order they were submitted. Django translations are thread-local, and
+    in this mode KeywordHandler doesn't set ``contact.language``: the
+    language of each message is only given by the ``lang_code`` argument
+    and the active translation.
+"""
+
+import logging
+import threading
+from Queue import Queue
+from collections import deque
+
+from .context import get_context
+
+
+logger = logging.getLogger(__name__)
+
+
+# tells a worker to exit
+_STOP = object()
+
+
+def connection_key(msg):
+    """
+        Return what identifies the sender of a message. The backend id is
+        used rather than the backend, so it's not fetched from the database.
+    """
+    connection = msg.connection
+    if connection is None:
+        return None
+    return (connection.backend_id, connection.identity)
+
+
+class DispatchPool(object):
+    """
+        Handle messages with ``app.handle`` in ``workers`` threads::
+
+            >>> pool = DispatchPool(app, 4)
+            >>> pool.submit(msg, callback=lambda msg, accepted: ...)
+            >>> pool.join()
+
+        The callback is called in the worker thread, once the message is
+        handled. It must send the responses (e.g. ``msg.flush_responses()``)
+        since the router has already finished with the message.
+    """
+
+    def __init__(self, app, workers=4):
+        self.app = app
+        # connection key: deque of (msg, callback) waiting to be handled.
+        # A key is in this dict while a worker handles its messages, and
+        # only in the queue once.
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work,
+                                      name="handlers_i18n-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+
+    def submit(self, msg, callback=None):
+        """
+            Queue a message. It is handled after the messages from the same
+            connection submitted before.
+        """
+
+        get_context(msg).concurrent = True
+
+        key = connection_key(msg)
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].append((msg, callback))
+                return
+            self._pending[key] = deque([(msg, callback)])
+        self._queue.put(key)
+
+
+    def join(self):
+        """
+            Wait until all the messages submitted are handled.
+        """
+        self._queue.join()
+
+
+    def stop(self):
+        """
+            Handle the messages already submitted and stop the threads.
+        """
+        for thread in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+    def _work(self):
+
+        while True:
+            key = self._queue.get()
+            try:
+                if key is _STOP:
+                    return
+                self._handle_connection(key)
+            finally:
+                self._queue.task_done()
+
+
+    def _handle_connection(self, key):
+        """
+            Handle the messages of a connection until there is none left.
+        """
+
+        while True:
+            with self._lock:
+                messages = self._pending[key]
+                if not messages:
+                    del self._pending[key]
+                    return
+                msg, callback = messages[0]
+
+            try:
+                accepted = self.app.handle(msg)
+                if callback is not None:
+                    callback(msg, accepted)
+            except Exception:
+                logger.exception("Error while handling %r from %s",
+                                 msg.text, msg.connection)
+
+            # leave the message in the deque while it's handled, so
+            # submit() knows a worker is on this connection
+            with self._lock:
+                messages.popleft()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Flood control: a phone or a gateway sending messages in a loop should
+    not starve the other connections.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TokenBucket(object):
+
+    __slots__ = ('tokens', 'time', 'notified')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.time = now
+        self.notified = False
+
+
+class RateLimiter(object):
+    """
+        Allow ``count`` messages per ``period`` seconds for each key (e.g.
+        a connection), with a token bucket per key: it holds up to
+        ``count`` tokens, a message takes one, and they come back at a rate
+        of ``count`` per ``period``. So a burst of ``count`` messages is
+        allowed, then one message every ``period / count`` seconds.
+
+        A bucket left alone for ``period`` seconds is full again, which is
+        the same as no bucket: buckets are kept by order of use, and the
+        idle ones are dropped as other keys are used, so memory only
+        depends on the number of keys seen during the last period.
+    """
+
+    def __init__(self, count, period):
+        self.count = count
+        self.period = period
+        self.rate = float(count) / period
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def _bucket(self, key, now):
+        """
+            Return the bucket of the key refilled up to now, as the most
+            recently used one, and drop the idle buckets. Must be called
+            with the lock.
+        """
+
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(self.count, now)
+        else:
+            bucket.tokens = min(self.count,
+                                bucket.tokens + (now - bucket.time) * self.rate)
+            bucket.time = now
+        self._buckets[key] = bucket
+
+        idle = now - self.period
+        while True:
+            oldest = next(iter(self._buckets))
+            if self._buckets[oldest].time > idle:
+                break
+            del self._buckets[oldest]
+
+        return bucket
+
+
+    def take(self, key):
+        """
+            Take a token for this key and return True, or return False if
+            there is none left.
+        """
+        with self._lock:
+            bucket = self._bucket(key, time.time())
+            if bucket.tokens < 1:
+                return False
+            bucket.tokens -= 1
+            bucket.notified = False
+            return True
+
+
+    def available(self, key):
+        """
+            Return True if take() would succeed, without taking a token.
+        """
+        with self._lock:
+            return self._bucket(key, time.time()).tokens >= 1
+
+
+    def notify(self, key):
+        """
+            Return True the first time it's called for a key since it ran
+            out of tokens, to send only one notice.
+        """
+        with self._lock:
+            bucket = self._bucket(key, time.time())
+            if bucket.notified:
+                return False
+            bucket.notified = True
+            return True
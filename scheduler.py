@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Order in which the fallback handlers (the ones not in the keyword
+    index) are tried.
+
+    Handlers can declare where they stand when the order matters:
+
+    - ``priority``: handlers with a priority are tried before all the
+      others, highest priority first, and are never reordered.
+    - ``after``: names of handler classes which must be tried before this
+      one, e.g. a catch-all handler tried after a more specific one.
+
+    With ADAPTIVE_HANDLERS_ORDER, the other handlers are periodically
+    reordered so the ones which accept the most messages are tried first.
+"""
+
+import threading
+
+
+def order_handlers(handlers, rates=None):
+    """
+        Return the handlers sorted by priority, then by decreasing accept
+        rate (a dict handler: rate), then by their order in the list, under
+        the ``after`` constraints. Raise ValueError if the constraints can't
+        be satisfied.
+    """
+
+    rates = rates or {}
+    names = dict((handler.__name__, handler) for handler in handlers)
+
+    def key(item):
+        position, handler = item
+        priority = getattr(handler, 'priority', None)
+        if priority is not None:
+            return (0, -priority, position)
+        return (1, -rates.get(handler, 0), position)
+
+    pending = sorted(enumerate(handlers), key=key)
+    before = dict((handler, set(names[name]
+                                for name in getattr(handler, 'after', ())
+                                if name in names))
+                  for handler in handlers)
+
+    ordered = []
+    placed = set()
+    while pending:
+        for i, (position, handler) in enumerate(pending):
+            if before[handler] <= placed:
+                break
+        else:
+            raise ValueError("Circular 'after' constraints between %s" % (
+                             ", ".join(h.__name__ for p, h in pending)))
+        del pending[i]
+        ordered.append(handler)
+        placed.add(handler)
+
+    return ordered
+
+
+class HandlerScheduler(object):
+    """
+        Count how often each handler accepts the messages it is tried on,
+        and reorder the handlers every ``interval`` tries. Counts are halved
+        at each reordering, so the order follows changes in the traffic.
+
+        ``handlers`` is the current order. It is replaced, never modified,
+        so it can be iterated while another thread reorders it.
+    """
+
+    def __init__(self, handlers, interval=1000):
+        self.interval = interval
+        self.handlers = order_handlers(handlers)
+        self.accepted = dict.fromkeys(self.handlers, 0)
+        self.tried = dict.fromkeys(self.handlers, 0)
+        self._count = 0
+        self._lock = threading.Lock()
+
+
+    def record(self, handler, accepted):
+        """
+            Count a try of a handler, and reorder the handlers every
+            ``interval`` tries. Other handlers are ignored.
+        """
+
+        if handler not in self.tried:
+            return
+
+        with self._lock:
+            self.tried[handler] += 1
+            if accepted:
+                self.accepted[handler] += 1
+            self._count += 1
+            if self._count >= self.interval:
+                self._count = 0
+                self.reorder()
+
+
+    def rates(self):
+        """
+            Return a dict handler: accept rate. Handlers rarely tried get a
+            rate close to 0.5 (one accepted message out of two tries assumed
+            beforehand), so they are not put last after a few rejections.
+        """
+        return dict((handler, (self.accepted[handler] + 1.0) /
+                              (self.tried[handler] + 2.0))
+                    for handler in self.handlers)
+
+
+    def reorder(self):
+        self.handlers = order_handlers(self.handlers, self.rates())
+        for handler in self.handlers:
+            self.accepted[handler] //= 2
+            self.tried[handler] //= 2
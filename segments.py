@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    How many SMS a text costs: texts only made of characters of the GSM
+    03.38 alphabet are sent 7 bits per character, 160 characters in one
+    SMS or 153 per part of a concatenated SMS. Other texts are sent in
+    UCS-2, 70 characters in one SMS or 67 per part.
+"""
+
+
+GSM7_BASIC = frozenset(
+    u"@\xa3$\xa5\xe8\xe9\xf9\xec\xf2\xc7\n\xd8\xf8\r\xc5\xe5"
+    u"Δ_ΦΓΛΩΠΨΣΘΞ"
+    u"\xc6\xe6\xdf\xc9 !\"#\xa4%&'()*+,-./0123456789:;<=>?"
+    u"\xa1ABCDEFGHIJKLMNOPQRSTUVWXYZ\xc4\xd6\xd1\xdc\xa7"
+    u"\xbfabcdefghijklmnopqrstuvwxyz\xe4\xf6\xf1\xfc\xe0")
+
+# characters sent with an escape character, so they count twice
+GSM7_EXTENSION = frozenset(u"^{}\\[~]|€\x0c")
+
+GSM7 = 'gsm7'
+UCS2 = 'ucs2'
+
+# (max length of a single SMS, max length of each part of a long SMS)
+LIMITS = {
+    GSM7: (160, 153),
+    UCS2: (70, 67),
+}
+
+
+def count_segments(text):
+    """
+        Return a tuple (encoding, number of SMS) for this text, encoding
+        being GSM7 or UCS2.
+    """
+
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+
+    length = 0
+    for char in text:
+        if char in GSM7_BASIC:
+            length += 1
+        elif char in GSM7_EXTENSION:
+            length += 2
+        else:
+            encoding = UCS2
+            length = len(text)
+            break
+    else:
+        encoding = GSM7
+
+    single, part = LIMITS[encoding]
+    if length <= single:
+        return encoding, 1
+    return encoding, (length + part - 1) // part
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+# -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4
 
 import os
@@ -9,3 +10,57 @@ EXCLUDED_HANDLERS = (module_name + '.handlers.base.BaseHandler',
                      module_name + '.handlers.callback.CallbackHandler',
                      module_name + '.handlers.keyword.KeywordHandler',
                      module_name + '.handlers.keyword.PatternHandler')
+
+# merge all the pattern handlers into a single regular expression
+MERGE_PATTERN_HANDLERS = False
+
+# cache the objects found by helpers.check_exists(): max number of entries
+# (0 to disable the cache) and time to live in seconds
+LOOKUP_CACHE_SIZE = 0
+LOOKUP_CACHE_TTL = 300
+
+# path of a file where to save the handlers found, to only scan the apps
+# which handlers changed when the router starts
+HANDLERS_MANIFEST = None
+
+# only import keyword handlers when their keyword is first received. It
+# requires HANDLERS_MANIFEST.
+LAZY_HANDLERS = False
+
+# if the first word of a message is not a keyword, use the closest keyword
+# within this edit distance (0 to disable)
+KEYWORD_FUZZY_DISTANCE = 0
+
+# collect dispatch metrics (see metrics.py), and write them to this file
+# every HANDLERS_METRICS_INTERVAL seconds
+HANDLERS_METRICS = False
+HANDLERS_METRICS_FILE = None
+HANDLERS_METRICS_INTERVAL = 60
+
+# try the handlers which are not keyword handlers in the order of their
+# accept rate, updated every ADAPTIVE_HANDLERS_INTERVAL tries
+ADAPTIVE_HANDLERS_ORDER = False
+ADAPTIVE_HANDLERS_INTERVAL = 1000
+
+# number of threads handling the messages passed to App.submit()
+HANDLERS_WORKERS = 4
+
+# characters separating the keyword from the data, besides whitespace,
+# e.g. u',;#'
+KEYWORD_SEPARATORS = u''
+
+# match keywords regardless of accents, e.g. 'resultat' for 'résultat'
+KEYWORD_FOLD_ACCENTS = False
+
+# don't handle again the messages received twice from the same connection
+# within this number of seconds (0 to disable). Duplicates are answered
+# with the same responses, or dropped if DUPLICATE_ANSWER is False. At most
+# DUPLICATE_CACHE_SIZE messages are remembered.
+DUPLICATE_WINDOW = 0
+DUPLICATE_ANSWER = True
+DUPLICATE_CACHE_SIZE = 10000
+
+# max number of messages handled per connection: a tuple (count, seconds),
+# e.g. (20, 60). Handlers can have their own limit in their rate_limit
+# attribute. Connections over the limit get one notice, then are ignored.
+RATE_LIMIT = None
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    In-memory stand-ins for the RapidSMS router, backends, connections and
+    contacts, to dispatch messages without a database.
+"""
+
+import itertools
+
+
+_ids = itertools.count(1)
+
+
+class FakeBackend(object):
+
+    def __init__(self, name="mock"):
+        self.pk = self.id = _ids.next()
+        self.name = name
+
+    def __unicode__(self):
+        return self.name
+
+
+class FakeContact(object):
+
+    def __init__(self, name=u"", language=None):
+        self.pk = self.id = _ids.next()
+        self.name = name
+        self.language = language
+
+    def save(self, *args, **kwargs):
+        pass
+
+    def __unicode__(self):
+        return self.name
+
+
+class FakeConnection(object):
+
+    def __init__(self, identity, backend=None, contact=None):
+        self.pk = self.id = _ids.next()
+        self.identity = identity
+        self.backend = backend or FakeBackend()
+        self.contact = contact
+
+    @property
+    def backend_id(self):
+        return self.backend.pk
+
+    @property
+    def contact_id(self):
+        return self.contact.pk if self.contact else None
+
+    def __unicode__(self):
+        return u"%s via %s" % (self.identity, self.backend)
+
+
+class FakeRouter(object):
+    """
+        Collects the messages sent instead of sending them.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def outgoing(self, msg):
+        self.sent.append(msg)
+
+
+class Harness(object):
+    """
+        Test a handler in isolation, like BaseHandler.test(), but with
+        in-memory backend, connection and contact: no database is needed,
+        so thousands of cases run in a fraction of a second::
+
+            >>> harness = Harness(AbcHandler, language='fr')
+            >>> harness.test("hello")
+            ['Here is some help.']
+            >>> harness.test_many(["hello you", "nothing"])
+            [['You said: you.'], False]
+
+        ``language`` is the language of the contact sending the messages, so
+        KeywordHandler.AUTO_SET_LANG is exercised. Set ``contact`` to False
+        to send messages from a connection without contact. The same contact
+        is used for all the messages, as it would be in production.
+    """
+
+    def __init__(self, handler, identity="mock", language=None, contact=True):
+        self.handler = handler
+        self.router = FakeRouter()
+        self.contact = FakeContact(language=language) if contact else None
+        self.connection = FakeConnection(identity, contact=self.contact)
+
+
+    def test(self, text):
+        """
+            Dispatch a message containing ``text`` and return the list of
+            the text of each response, or False if the handler ignored it.
+        """
+
+        # models can't be loaded until the django ORM is ready.
+        from rapidsms.messages import IncomingMessage
+
+        msg = IncomingMessage(connection=self.connection, text=text)
+        accepted = self.handler.dispatch(self.router, msg)
+        return [m.text for m in msg.responses]\
+            if accepted else False
+
+
+    def test_many(self, texts):
+        """
+            Same as test() for several texts, returns a list of results.
+        """
+        return [self.test(text) for text in texts]
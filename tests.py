@@ -2,11 +2,39 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
+from nose.plugins.skip import SkipTest
 from rapidsms.conf import settings
 from .utils import get_handlers
 
 
+def _make_app(handlers, keyword_handlers=None):
+    """
+    Return an App registering these handlers, with an in-memory router.
+    """
+
+    from .app import App
+    from .testing import FakeRouter
+
+    app = App(FakeRouter())
+    app.register(handlers, keyword_handlers)
+    return app
+
+
+def _handle(app, connection, text):
+    """
+    Handle a message with the app, and return whether it was accepted and
+    the text of its responses.
+    """
+
+    # models can't be loaded until the django ORM is ready.
+    from rapidsms.messages import IncomingMessage
+
+    msg = IncomingMessage(connection=connection, text=text)
+    accepted = app.handle(msg)
+    return bool(accepted), [response.text for response in msg.responses]
+
+
 def test_get_handlers():
 
     # store current settings.
@@ -51,3 +79,1156 @@ def test_get_handlers():
         settings.INSTALLED_HANDLERS,\
         settings.EXCLUDED_HANDLERS = _settings
 
+
+def _make_handlers_app(directory):
+    """
+    Create an app in ``directory`` with a single keyword handler, and return
+    the name of the app and the path of the handler file. ``directory``
+    must be in sys.path.
+    """
+
+    import os
+
+    app_name = os.path.basename(directory)
+    handlers_path = os.path.join(directory, app_name, 'handlers')
+    os.makedirs(handlers_path)
+    for path in (os.path.join(directory, app_name), handlers_path):
+        open(os.path.join(path, '__init__.py'), 'w').close()
+
+    handler_path = os.path.join(handlers_path, 'hello.py')
+    with open(handler_path, 'w') as f:
+        f.write("from %s.handlers.keyword import KeywordHandler\n"
+                "\n"
+                "class HelloHandler(KeywordHandler):\n"
+                "    keyword = 'hello'\n"
+                "\n"
+                "    def help(self, keyword, lang_code):\n"
+                "        self.respond(u'hello')\n" % __name__.rsplit('.', 1)[0])
+
+    return app_name, handler_path
+
+
+def test_handlers_manifest():
+
+    import os
+    import sys
+    import json
+    import shutil
+    import tempfile
+    from .utils import _load_manifest
+
+    directory = tempfile.mkdtemp(prefix='handlers_app_')
+    sys.path.insert(0, directory)
+    try:
+        app_name, handler_path = _make_handlers_app(directory)
+        manifest_path = os.path.join(directory, 'manifest.json')
+        name = '%s.handlers.hello.HelloHandler' % app_name
+
+        manifest = _load_manifest([app_name], manifest_path)
+        entry = manifest['apps'][app_name]
+        assert_equal(entry['handlers'], [name])
+        assert_equal(entry['keywords'].keys(), [name])
+        assert_equal(sorted(os.listdir(directory)),
+                     sorted([app_name, 'manifest.json']))
+
+        # the apps which files didn't change are not scanned again
+        entry['handlers'] = []
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        manifest = _load_manifest([app_name], manifest_path)
+        assert_equal(manifest['apps'][app_name]['handlers'], [])
+
+        # the others are
+        mtime = os.path.getmtime(handler_path) + 10
+        os.utime(handler_path, (mtime, mtime))
+        manifest = _load_manifest([app_name], manifest_path)
+        assert_equal(manifest['apps'][app_name]['handlers'], [name])
+        assert_equal(sorted(os.listdir(directory)),
+                     sorted([app_name, 'manifest.json']))
+
+        # and so are the apps which handlers inherit from a changed module
+        from .handlers import keyword
+        entry = manifest['apps'][app_name]
+        keyword_path = os.path.splitext(keyword.__file__)[0] + '.py'
+        assert keyword_path in entry['dependencies']
+        entry['handlers'] = []
+        entry['dependencies'][keyword_path] -= 10
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        manifest = _load_manifest([app_name], manifest_path)
+        assert_equal(manifest['apps'][app_name]['handlers'], [name])
+
+    finally:
+        sys.path.remove(directory)
+        shutil.rmtree(directory)
+
+
+def test_lazy_handlers():
+
+    import os
+    import sys
+    import shutil
+    import tempfile
+    from .utils import get_lazy_handlers, LazyHandler
+    from .testing import FakeConnection
+
+    _settings = (
+        settings.INSTALLED_APPS,
+        settings.INSTALLED_HANDLERS,
+        settings.EXCLUDED_HANDLERS,
+        getattr(settings, 'HANDLERS_MANIFEST', None))
+
+    directory = tempfile.mkdtemp(prefix='handlers_app_')
+    sys.path.insert(0, directory)
+    try:
+        app_name, handler_path = _make_handlers_app(directory)
+        module_name = '%s.handlers.hello' % app_name
+        settings.INSTALLED_APPS = [app_name]
+        settings.INSTALLED_HANDLERS = None
+        settings.EXCLUDED_HANDLERS = None
+        settings.HANDLERS_MANIFEST = os.path.join(directory, 'manifest.json')
+
+        # once the manifest is built, keyword handlers are not imported
+        get_lazy_handlers()
+        del sys.modules[module_name]
+        handlers, keyword_handlers = get_lazy_handlers()
+        assert_equal(handlers, [])
+        [(handler, keywords)] = keyword_handlers
+        assert isinstance(handler, LazyHandler)
+        assert_equal(keywords.keys(), ['hello'])
+
+        app = _make_app(handlers, keyword_handlers)
+        connection = FakeConnection('123')
+        assert_equal(_handle(app, connection, u'nothing'), (False, []))
+        assert module_name not in sys.modules
+
+        # they are routed with the keywords of the manifest, and imported
+        # on first use
+        assert_equal(_handle(app, connection, u'hello'), (True, [u'hello']))
+        assert module_name in sys.modules
+        assert_equal(_handle(app, connection, u'HELLO'), (True, [u'hello']))
+
+    finally:
+        settings.INSTALLED_APPS,\
+        settings.INSTALLED_HANDLERS,\
+        settings.EXCLUDED_HANDLERS,\
+        settings.HANDLERS_MANIFEST = _settings
+        sys.path.remove(directory)
+        shutil.rmtree(directory)
+
+
+def test_indexed_keywords():
+
+    from .handlers.keyword import KeywordHandler
+
+    class HelloHandler(KeywordHandler):
+        keyword = "Hello "
+        aliases = ((settings.LANGUAGE_CODE, ('hi', 'salut')),
+                   (settings.LANGUAGES[-1][0], ('salut',)))
+
+    indexed = HelloHandler.indexed_keywords()
+    assert_equal(indexed['hello'], settings.LANGUAGE_CODE)
+    assert_equal(indexed['hi'], settings.LANGUAGE_CODE)
+    # duplicate aliases never force the language
+    assert_equal(indexed['salut'], None)
+
+    # the tables are per class and read-only
+    class OtherHelloHandler(KeywordHandler):
+        keyword = "hello"
+
+    assert_equal(OtherHelloHandler.keywords(),
+                 {'hello': settings.LANGUAGE_CODE})
+    assert_raises(TypeError, HelloHandler.keywords().update, {'x': 'y'})
+
+    # bad languages fail when the class is created
+    assert_raises(ValueError, type, 'BadHandler', (KeywordHandler,),
+                  {'keyword': 'bad', 'aliases': (('xx-bad', ('b',)),)})
+
+
+def test_pattern_registry():
+
+    from .handlers.pattern import PatternHandler, PatternRegistry
+
+    class SumHandler(PatternHandler):
+        pattern = r'^(\d+) plus (\d+)$'
+
+    class HelloHandler(PatternHandler):
+        pattern = r'^hello (\w+)'
+
+    class TwiceHandler(PatternHandler):
+        pattern = r'^(\w+) \1$'
+
+    registry = PatternRegistry([SumHandler, HelloHandler, TwiceHandler])
+    assert_equal(registry.unmerged, [TwiceHandler])
+    assert_equal(registry.match("1 plus 2"), (SumHandler, ('1', '2')))
+    assert_equal(registry.match("HELLO bob"), (HelloHandler, ('bob',)))
+    assert_equal(registry.match("1 plus 2 "), None)
+
+    # more groups than a single regexp can hold
+    handlers = [type('Word%dHandler' % i, (PatternHandler,),
+                     {'pattern': r'^w%d (\w+) (\w+)$' % i})
+                for i in xrange(100)]
+    registry = PatternRegistry(handlers)
+    assert_equal(len(registry.handlers), 100)
+    assert len(registry.regexes) > 1
+    assert_equal(registry.match("w0 a b"), (handlers[0], ('a', 'b')))
+    assert_equal(registry.match("w99 c d"), (handlers[99], ('c', 'd')))
+    assert_equal(registry.match("w100 c d"), None)
+
+
+def test_dispatch_context():
+
+    from .context import get_context
+
+    class Object(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    contact = Object(language=None)
+    msg = Object(text=u" HeLLo  my friend ",
+                 connection=Object(contact=contact))
+
+    context = get_context(msg)
+    assert_equal(context.contact, contact)
+    assert_equal(context.lang_code, settings.LANGUAGE_CODE)
+    assert_equal(context.first_word, u"hello")
+    assert_equal(context.text, u"my friend ")
+    # resolved only once per message
+    assert get_context(msg) is context
+
+
+def test_lookup_cache():
+
+    from .helpers import LookupCache
+
+    class Model(object):
+        pass
+
+    cache = LookupCache(max_size=2, ttl=60)
+    cache._models.add(Model) # don't connect the signals
+
+    cache.set((Model, 'code', 'a'), 1)
+    cache.set((Model, 'code', 'b'), 2)
+    assert_equal(cache.get((Model, 'code', 'a')), 1)
+    
+    # 'b' is the least recently used
+    cache.set((Model, 'code', 'c'), 3)
+    assert_raises(KeyError, cache.get, (Model, 'code', 'b'))
+    assert_equal(cache.get((Model, 'code', 'c')), 3)
+
+    cache.invalidate(Model)
+    assert_raises(KeyError, cache.get, (Model, 'code', 'a'))
+
+    cache.ttl = -1
+    cache.set((Model, 'code', 'a'), 1)
+    assert_raises(KeyError, cache.get, (Model, 'code', 'a'))
+
+
+def test_date_parser():
+
+    import datetime
+    from .helpers import DateParser
+    from .exceptions import ExitHandle
+
+    parser = DateParser(('%d%m%y', '%d%m%Y'), '/-. ')
+    date = datetime.datetime(2010, 3, 12)
+    assert_equal(parser.parse_all([u'12/03/10', '120310', u'12-3-2010']),
+                 [date] * 3)
+    assert_raises(ExitHandle, parser.parse, u'31/02/2010')
+    assert_raises(ExitHandle, parser.parse, u'hello')
+
+    # literal characters must match, as with strptime()
+    parser = DateParser('%d.%m.%Y')
+    assert_equal(parser.parse(u'12.03.2010'), date)
+    assert_raises(ExitHandle, parser.parse, u'12x03x2010')
+    assert_equal(DateParser('%d %m %Y').parse(u'12  03 2010'), date)
+
+
+def test_check_date():
+
+    import datetime
+    from .helpers import check_date
+
+    date = datetime.datetime(2010, 3, 12)
+    assert_equal(check_date(u'12/03/10', '%d%m%y', '/'), date)
+    # formats can be a list
+    assert_equal(check_date(u'12/03/10', ['%d%m%y', '%d%m%Y'], '/'), date)
+    assert_equal(check_date(u'12/03/2010', ['%d%m%y', '%d%m%Y'], '/'), date)
+
+
+def test_check_all_exist():
+
+    from . import helpers
+    from .exceptions import ExitHandle
+
+    class Field(object):
+        verbose_name = u'code'
+
+        def to_python(self, value):
+            return value
+
+    class Meta(object):
+        verbose_name = u'product'
+
+        def get_field(self, name):
+            return Field()
+
+        def get_field_by_name(self, name):
+            return Field(), None, True, False
+
+    class Product(object):
+        _meta = Meta()
+
+        class DoesNotExist(Exception):
+            pass
+
+        def __init__(self, code):
+            self.code = code
+
+    class Manager(object):
+        # a case insensitive collation
+        products = [Product(u'Foo'), Product(u'bar')]
+
+        def filter(self, code__in):
+            codes = set(code.lower() for code in code__in)
+            return [p for p in self.products if p.code.lower() in codes]
+
+        def get(self, code):
+            for product in self.products:
+                if product.code.lower() == code.lower():
+                    return product
+            raise Product.DoesNotExist()
+
+    Product.objects = Manager()
+
+    cache_bak = helpers.lookup_cache
+    helpers.lookup_cache = None
+    try:
+        assert_equal([p.code for p in 
+                      helpers.check_all_exist([u'foo', u'bar'], Product)],
+                     [u'Foo', u'bar'])
+        assert_raises(ExitHandle, helpers.check_all_exist, [u'bar', u'baz'],
+                      Product)
+    finally:
+        helpers.lookup_cache = cache_bak
+
+
+def test_args_spec():
+
+    from .helpers import ArgsSpec, require_args
+    from .exceptions import ExitHandle
+
+    spec = ArgsSpec((2, (4, 7), 9))
+    assert_equal(spec.counts, frozenset((2, 4, 5, 6, 9)))
+    spec.check('a b'.split())
+    try:
+        spec.check('a b c'.split())
+    except ExitHandle as e:
+        assert_equal(e.message, u'This command expects 2, 4, 5, 6 or 9 '
+                                u'value(s). You provided 3.')
+    else:
+        raise AssertionError('ExitHandle not raised')
+
+    # require_args() caches the specs, even with slices given as lists
+    require_args('a b c d'.split(), slices=[2, [4, 7]])
+    require_args('a b c d'.split(), slices=[2, [4, 7]])
+    try:
+        require_args('a b c'.split(), slices=[2, [4, 7]])
+    except ExitHandle:
+        pass
+    else:
+        raise AssertionError('ExitHandle not raised')
+
+
+def test_args_parser():
+
+    import datetime
+    from .helpers import ArgsParser, Arg, Int, Date
+    from .exceptions import ExitHandle
+
+    parser = ArgsParser((Int('quantity'), Date('date', '%d%m%Y', '/'),
+                         Arg('comment', optional=True, rest=True)))
+    assert_equal(parser.parse(u'12 03/10/2010 out of  stock'),
+                 {'quantity': 12, 'date': datetime.datetime(2010, 10, 3),
+                  'comment': u'out of  stock'})
+    assert_equal(parser.parse(u'12 03/10/2010')['comment'], None)
+    assert_raises(ExitHandle, parser.parse, u'12')
+    assert_raises(ExitHandle, parser.parse, u'twelve 03/10/2010')
+
+    assert_raises(ValueError, ArgsParser, (Arg('a', optional=True), Arg('b')))
+    assert_raises(ValueError, ArgsParser, (Arg('a', rest=True), Arg('b')))
+
+
+def test_fuzzy_index():
+
+    from .fuzzy import FuzzyIndex
+
+    index = FuzzyIndex(['hello', 'report', 'stock', 'ok'], 1)
+    assert_equal(index.lookup('hello'), 'hello')
+    assert_equal(index.lookup('helo'), 'hello')
+    assert_equal(index.lookup('hlelo'), 'hello')
+    assert_equal(index.lookup('reoprt'), 'report')
+    assert_equal(index.lookup('stocks'), 'stock')
+    assert_equal(index.lookup('stack'), 'stock')
+    assert_equal(index.lookup('hellooo'), None)
+    # too short to be matched
+    assert_equal(index.lookup('ko'), None)
+
+
+def test_fuzzy_routing():
+
+    from .handlers.keyword import KeywordHandler
+    from .handlers.pattern import PatternHandler
+    from .fuzzy import FuzzyIndex
+    from .testing import FakeConnection
+
+    class StockHandler(KeywordHandler):
+        keyword = "stock"
+
+        def help(self, keyword, lang_code):
+            self.respond(u'stock')
+
+    class StickHandler(PatternHandler):
+        pattern = r'^stick (\d+)$'
+
+        def handle(self, count):
+            self.respond(u'stick %s' % count)
+
+    app = _make_app([StockHandler, StickHandler])
+    app.fuzzy_index = FuzzyIndex(app.keyword_index, 1)
+    connection = FakeConnection('123')
+
+    # close keywords are only used when no other handler matches
+    assert_equal(_handle(app, connection, u'stick 3'), (True, [u'stick 3']))
+    assert_equal(_handle(app, connection, u'stick'), (True, [u'stock']))
+    assert_equal(_handle(app, connection, u'stok'), (True, [u'stock']))
+
+
+def test_keyword_trie():
+
+    from .trie import KeywordTrie
+
+    trie = KeywordTrie(['stock', 'stock out', 'hello'], u',#')
+    assert_equal(trie.match(u'Stock Out, 3 boxes'), ('stock out', u'3 boxes'))
+    assert_equal(trie.match(u' stock  out'), ('stock out', None))
+    assert_equal(trie.match(u'stock#3'), ('stock', u'3'))
+    assert_equal(trie.match(u'stock outside'), ('stock', u'outside'))
+    assert_equal(trie.match(u'hello,world'), ('hello', u'world'))
+    assert_equal(trie.match(u'helloworld'), None)
+    assert_equal(trie.match(u''), None)
+
+
+def test_prefilter():
+
+    from .handlers.callback import Prefilter
+
+    prefilter = Prefilter(prefixes=('i love', 'i like'), max_length=20)
+    assert prefilter.accepts(u'i love you')
+    assert not prefilter.accepts(u'you love me')
+    assert not prefilter.accepts(u'i love you more than anything')
+
+    prefilter = Prefilter(chars=u'0123456789 ', leading_digit=True,
+                          min_length=3)
+    assert prefilter.accepts(u'12 34')
+    assert not prefilter.accepts(u'12 a4')
+    assert not prefilter.accepts(u'12')
+    assert not prefilter.accepts(u'a12')
+
+    from .handlers.callback import CallbackHandler
+    from .testing import Harness
+
+    matched = []
+
+    class NumbersHandler(CallbackHandler):
+        prefilter = Prefilter(chars=u'0123456789 ', leading_digit=True)
+
+        @classmethod
+        def match(cls, msg):
+            matched.append(msg.text)
+            return msg.text.split()
+
+        def handle(self, match):
+            self.respond(u'%d' % sum(map(int, match)))
+
+    # match() is only called for the messages passing the prefilter
+    assert_equal(Harness(NumbersHandler).test_many([u'12 30', u'hello']),
+                 [[u'42'], False])
+    assert_equal(matched, [u'12 30'])
+
+
+def test_duplicate_filter():
+
+    from .context import DispatchContext
+    from .dedup import DuplicateFilter
+    from .testing import FakeConnection
+
+    class Msg(object):
+        def __init__(self, connection, text):
+            self.connection = connection
+            self.text = text
+            self.responses = []
+
+    class Response(object):
+        text = u'ok'
+
+    connection = FakeConnection('123')
+    duplicates = DuplicateFilter(window=60, max_size=2)
+    first = DispatchContext(Msg(connection, u'Stock 12'))
+    first.msg.responses.append(Response())
+    duplicates.add(first, True)
+
+    assert_equal(duplicates.get(DispatchContext(Msg(connection, u' stock  12'))),
+                 (True, (u'ok',)))
+    assert_equal(duplicates.get(DispatchContext(Msg(connection, u'stock 13'))),
+                 None)
+    assert_equal(duplicates.get(DispatchContext(Msg(FakeConnection('456'),
+                                                    u'stock 12'))), None)
+
+    # the oldest messages are forgotten first
+    duplicates.add(DispatchContext(Msg(connection, u'a')), False)
+    duplicates.add(DispatchContext(Msg(connection, u'b')), False)
+    assert_equal(duplicates.get(first), None)
+
+    duplicates = DuplicateFilter(window=-1)
+    duplicates.add(first, True)
+    assert_equal(duplicates.get(first), None)
+
+
+def test_handle_batch():
+
+    from .handlers.keyword import KeywordHandler
+    from .handlers.callback import CallbackHandler
+    from .testing import FakeConnection, FakeContact
+    from rapidsms.messages import IncomingMessage
+
+    other_lang = settings.LANGUAGES[-1][0]
+    handled = []
+
+    class HelloHandler(KeywordHandler):
+        keyword = "hello"
+        aliases = ((other_lang, ('hhello',)),)
+
+        def help(self, keyword, lang_code):
+            handled.append((self.msg.connection.identity, self.msg.text))
+            self.respond(lang_code)
+
+    class EchoHandler(CallbackHandler):
+
+        @classmethod
+        def match(cls, msg):
+            return msg.text.startswith(u'echo')
+
+        def handle(self, match):
+            handled.append((self.msg.connection.identity, self.msg.text))
+            self.respond(self.msg.text)
+
+    app = _make_app([HelloHandler, EchoHandler])
+    first = FakeConnection('1')
+    second = FakeConnection('2')
+    messages = [IncomingMessage(connection=connection, text=text)
+                for connection, text in [(first, u'echo a'),
+                                         (second, u'hhello'),
+                                         (first, u'hello'),
+                                         (second, u'echo b'),
+                                         (first, u'nothing'),
+                                         (first, u'hhello')]]
+
+    results = [(accepted, [response.text for response in responses])
+               for accepted, responses in app.handle_batch(messages)]
+    assert_equal(results, [(True, [u'echo a']),
+                           (True, [other_lang]),
+                           (True, [settings.LANGUAGE_CODE]),
+                           (True, [u'echo b']),
+                           (False, []),
+                           (True, [other_lang])])
+
+    # the messages of each connection are handled in the order of the list
+    for connection in (first, second):
+        assert_equal([text for identity, text in handled
+                      if identity == connection.identity],
+                     [msg.text for msg in messages
+                      if msg.connection is connection and
+                         msg.text != u'nothing'])
+
+
+def test_batch_languages():
+
+    from django.utils import translation
+    from .handlers.keyword import KeywordHandler
+    from .handlers.callback import CallbackHandler
+    from .testing import FakeConnection, FakeContact
+    from rapidsms.messages import IncomingMessage
+
+    other_lang = settings.LANGUAGES[-1][0]
+
+    class HelloHandler(KeywordHandler):
+        keyword = "hello"
+        aliases = ((other_lang, ('hhello',)),)
+
+        def help(self, keyword, lang_code):
+            self.respond(translation.get_language())
+
+        def handle(self, text, keyword, lang_code):
+            return False
+
+    class LanguageHandler(CallbackHandler):
+
+        @classmethod
+        def match(cls, msg):
+            return u'language' in msg.text
+
+        def handle(self, match):
+            self.respond(translation.get_language())
+
+    app = _make_app([HelloHandler, LanguageHandler])
+    django_lang_bak = translation.get_language()
+    messages = [IncomingMessage(connection=FakeConnection(str(i)), text=text)
+                for i, text in enumerate([u'hhello', u'language',
+                                          u'hhello language'])]
+
+    # the other handlers don't run in the language of a keyword group,
+    # even after the keyword handler rejected the message
+    results = [[response.text for response in responses]
+               for accepted, responses in app.handle_batch(messages)]
+    assert_equal(results, [[other_lang], [django_lang_bak],
+                           [django_lang_bak]])
+    assert_equal(translation.get_language(), django_lang_bak)
+
+
+def test_prefetch_contacts():
+
+    from django.db import connection as db
+    from rapidsms.models import Backend, Connection, Contact
+    from rapidsms.messages import IncomingMessage
+
+    backend = Backend.objects.create(name="prefetch_test")
+    connections = [Connection.objects.create(
+                       backend=backend, identity=str(i),
+                       contact=Contact.objects.create(name=str(i)))
+                   for i in xrange(3)]
+    connections.append(Connection.objects.create(backend=backend,
+                                                 identity='none'))
+    # fresh instances, without their contact cached
+    connections = list(Connection.objects.filter(backend=backend)
+                                         .order_by('identity'))
+    messages = [IncomingMessage(connection=connection, text=u'hello')
+                for connection in connections + connections[:1]]
+
+    app = _make_app([])
+    use_debug_cursor = db.use_debug_cursor
+    db.use_debug_cursor = True
+    try:
+        queries = len(db.queries)
+        app.prefetch_contacts(messages)
+        contacts = [msg.connection.contact for msg in messages]
+        assert_equal(len(db.queries) - queries, 1)
+    finally:
+        db.use_debug_cursor = use_debug_cursor
+
+    assert_equal([contact.name if contact else None for contact in contacts],
+                 ['0', '1', '2', None, '0'])
+
+
+def test_batch_duplicates():
+
+    import time
+    from .handlers.keyword import KeywordHandler
+    from .dedup import DuplicateFilter
+    from .ratelimit import RateLimiter
+    from .context import get_context
+    from .testing import FakeConnection
+    from rapidsms.messages import IncomingMessage
+
+    class CountHandler(KeywordHandler):
+        keyword = "count"
+        handled = []
+
+        def help(self, keyword, lang_code):
+            self.handled.append(self.msg.text)
+            self.respond(u'%d' % len(self.handled))
+
+    app = _make_app([CountHandler])
+    app.duplicates = DuplicateFilter(window=60)
+    app.rate_limiter = RateLimiter(3, 60)
+    connection = FakeConnection('123')
+
+    def batch(*texts):
+        messages = [IncomingMessage(connection=connection, text=text)
+                    for text in texts]
+        results = app.handle_batch(messages)
+        return messages, [(accepted, [response.text for response in responses])
+                          for accepted, responses in results]
+
+    # a duplicate in the same batch is answered from the first message
+    messages, results = batch(u'count', u'COUNT ')
+    assert_equal(results, [(True, [u'1']), (True, [u'1'])])
+    assert_equal(CountHandler.handled, [u'count'])
+
+    # replayed and refused messages are not remembered again
+    first = get_context(messages[0])
+    expires = app.duplicates._items[app.duplicates.fingerprint(first)][0]
+    time.sleep(0.01)
+    messages, results = batch(u'count', u'count 2')
+    assert_equal(results[0], (True, [u'1']))
+    assert results[1][0]
+    assert_equal(CountHandler.handled, [u'count'])
+    assert_equal(app.duplicates._items[app.duplicates.fingerprint(first)][0],
+                 expires)
+    assert_equal(app.duplicates.get(get_context(messages[1])), None)
+
+
+def test_rate_limiter():
+
+    import time
+    from .ratelimit import RateLimiter
+
+    limiter = RateLimiter(2, 60)
+    assert limiter.take('a')
+    assert limiter.take('a')
+    assert not limiter.available('a')
+    assert not limiter.take('a')
+    assert limiter.take('b')
+    # one notice only
+    assert limiter.notify('a')
+    assert not limiter.notify('a')
+
+    # idle buckets are dropped
+    limiter = RateLimiter(1, 0.01)
+    limiter.take('a')
+    time.sleep(0.02)
+    limiter.take('b')
+    assert_equal(list(limiter._buckets), ['b'])
+
+
+def test_duplicates_rate_limit():
+
+    from .handlers.keyword import KeywordHandler
+    from .dedup import DuplicateFilter
+    from .ratelimit import RateLimiter
+    from .testing import FakeConnection
+
+    class HelloHandler(KeywordHandler):
+        keyword = "hello"
+
+        def help(self, keyword, lang_code):
+            self.respond(u'hello')
+
+    app = _make_app([HelloHandler])
+    app.duplicates = DuplicateFilter(window=60)
+    app.rate_limiter = RateLimiter(2, 60)
+    connection = FakeConnection('123')
+
+    # a gateway resending the same message doesn't get unlimited answers
+    assert_equal(_handle(app, connection, u'hello'), (True, [u'hello']))
+    assert_equal(_handle(app, connection, u'hello'), (True, [u'hello']))
+    accepted, responses = _handle(app, connection, u'hello')
+    assert accepted
+    assert responses != [u'hello']
+    assert_equal(len(responses), 1)
+    assert_equal(_handle(app, connection, u'hello'), (True, []))
+
+
+def test_handler_rate_limit():
+
+    from .handlers.callback import CallbackHandler
+    from .handlers.pattern import PatternHandler
+    from .testing import FakeConnection
+
+    class LimitedHandler(CallbackHandler):
+        rate_limit = (1, 60)
+
+        @classmethod
+        def match(cls, msg):
+            return msg.text.startswith(u'limited')
+
+        def handle(self, match):
+            self.respond(u'limited')
+
+    class OtherHandler(CallbackHandler):
+
+        @classmethod
+        def match(cls, msg):
+            return msg.text.startswith(u'other')
+
+        def handle(self, match):
+            self.respond(u'other')
+
+    class LimitedPatternHandler(PatternHandler):
+        pattern = r'^(\d+) plus (\d+)$'
+        rate_limit = (1, 60)
+
+        def handle(self, a, b):
+            self.respond(u'%d' % (int(a) + int(b)))
+
+    app = _make_app([LimitedHandler, OtherHandler, LimitedPatternHandler])
+    connection = FakeConnection('123')
+
+    assert_equal(_handle(app, connection, u'limited'), (True, [u'limited']))
+    assert_equal(_handle(app, connection, u'1 plus 2'), (True, [u'3']))
+
+    # over their limit, handlers are skipped for the messages they don't
+    # match, and only refuse the others, with one notice
+    assert_equal(_handle(app, connection, u'other'), (True, [u'other']))
+    assert_equal(_handle(app, connection, u'nothing'), (False, []))
+    accepted, responses = _handle(app, connection, u'limited again')
+    assert accepted
+    assert_equal(len(responses), 1)
+    assert_equal(_handle(app, connection, u'limited again'), (True, []))
+    assert_equal(_handle(app, connection, u'1 plus 3'), (True, responses))
+    assert_equal(_handle(app, FakeConnection('456'), u'limited'),
+                 (True, [u'limited']))
+
+
+def test_switch_language():
+
+    from django.utils import translation
+    from .context import switch_language
+
+    other_lang = settings.LANGUAGES[-1][0]
+    django_lang_bak = translation.get_language()
+    try:
+        translation.activate(settings.LANGUAGE_CODE)
+        assert_equal(switch_language(other_lang), settings.LANGUAGE_CODE)
+        assert_equal(translation.get_language(), other_lang)
+        assert_equal(switch_language(other_lang), other_lang)
+        # restore the previous language
+        assert_equal(switch_language(settings.LANGUAGE_CODE), other_lang)
+        assert_equal(translation.get_language(), settings.LANGUAGE_CODE)
+    finally:
+        translation.activate(django_lang_bak)
+
+
+def test_load_translations():
+
+    from django.utils import translation
+    from django.utils.translation import trans_real
+
+    django_lang_bak = translation.get_language()
+    app = _make_app([])
+    assert_equal(translation.get_language(), django_lang_bak)
+
+    # the catalogs are loaded by register(), and only once
+    catalogs = dict((lang_code, trans_real._translations[lang_code])
+                    for lang_code, name in settings.LANGUAGES)
+    app.load_translations()
+    assert_equal(translation.get_language(), django_lang_bak)
+    for lang_code, catalog in catalogs.iteritems():
+        assert trans_real._translations[lang_code] is catalog
+
+
+def test_fold_string():
+
+    from .context import fold_string
+
+    assert_equal(fold_string(u'r\xe9sultat'), u'resultat')
+    assert_equal(fold_string(u'\xe0 \xe7a \xee\xf1 \u0153uf'),
+                 u'a ca in oeuf')
+    assert_equal(fold_string('r\xc3\xa9sultat'), u'resultat')
+    assert_equal(fold_string(u'hello'), u'hello')
+
+
+def test_metrics():
+
+    from .metrics import Metrics
+
+    class SomeHandler(object):
+        pass
+
+    collector = Metrics()
+    collector.count(SomeHandler, 'accept')
+    collector.count(SomeHandler, 'accept')
+    collector.observe(SomeHandler, 'handle', 0.002)
+    collector.observe_tried(3)
+    collector.count_sms(SomeHandler, 2)
+
+    assert_equal(collector.counters[('SomeHandler', 'accept')], 2)
+    rendered = collector.render()
+    assert 'handlers_i18n_dispatch_total{handler="SomeHandler",'\
+           'outcome="accept"} 2' in rendered
+    assert 'handlers_i18n_latency_seconds_bucket{handler="SomeHandler",'\
+           'method="handle",le="0.0025"} 1' in rendered
+    assert 'handlers_i18n_tried_handlers_bucket{le="5"} 1' in rendered
+    assert 'handlers_i18n_sms_total{handler="SomeHandler"} 2' in rendered
+
+
+def test_failed_handler_metrics():
+
+    from .handlers.callback import CallbackHandler
+    from .scheduler import HandlerScheduler
+    from .testing import FakeConnection
+    from . import metrics
+
+    class FailingHandler(CallbackHandler):
+
+        @classmethod
+        def match(cls, msg):
+            return msg.text == u'fail'
+
+        def handle(self, match):
+            raise ValueError(match)
+
+    app = _make_app([FailingHandler])
+    app.scheduler = HandlerScheduler(app.fallback_handlers)
+    collector = metrics.enable()
+    try:
+        # errors are swallowed, but not counted as accepted
+        assert_equal(_handle(app, FakeConnection('123'), u'fail'), (True, []))
+        assert_equal(collector.counters.get(('FailingHandler', 'error')), 1)
+        assert_equal(collector.counters.get(('FailingHandler', 'accept')), None)
+        assert_equal(app.scheduler.accepted[FailingHandler], 0)
+        assert_equal(app.scheduler.tried[FailingHandler], 1)
+    finally:
+        metrics.disable()
+
+
+def test_benchmark():
+
+    from . import benchmark
+    from .testing import FakeRouter, FakeConnection
+    from rapidsms.messages import IncomingMessage
+
+    benchmark.main(['--keywords', '3', '--patterns', '1', '--callbacks', '1',
+                    '--connections', '5', '--messages', '50',
+                    '--warmup', '10'])
+
+    # the generated handlers can log
+    msg = IncomingMessage(connection=FakeConnection('1'), text=u'kw0')
+    for handler in (benchmark.make_keyword_handler(0, [], 0),
+                    benchmark.make_pattern_handler(0),
+                    benchmark.make_callback_handler(0)):
+        assert_equal(handler(FakeRouter(), msg)._logger_name(),
+                     'app/%s/%s' % (__name__.rsplit('.', 1)[0],
+                                    handler.__name__))
+
+
+def test_count_segments():
+
+    from .segments import count_segments, GSM7, UCS2
+
+    assert_equal(count_segments(u'hello'), (GSM7, 1))
+    assert_equal(count_segments(u'\xe9' * 160), (GSM7, 1))
+    assert_equal(count_segments(u'a' * 161), (GSM7, 2))
+    # extension characters count twice
+    assert_equal(count_segments(u'[' * 80 + u'a'), (GSM7, 2))
+    assert_equal(count_segments(u'\u0153' * 70), (UCS2, 1))
+    assert_equal(count_segments(u'\u0153' * 135), (UCS2, 3))
+
+
+def test_harness():
+
+    from .handlers.keyword import KeywordHandler
+    from .testing import Harness
+
+    other_lang = settings.LANGUAGES[-1][0]
+
+    class HelloHandler(KeywordHandler):
+        keyword = "harness"
+        aliases = ((other_lang, ('hharness',)),)
+
+        def help(self, keyword, lang_code):
+            self.respond(lang_code)
+
+        def handle(self, text, keyword, lang_code):
+            self.respond(text)
+
+    harness = Harness(HelloHandler)
+    assert_equal(harness.test_many(['harness', 'HHarness', 'harness hi',
+                                    'nothing']),
+                 [[settings.LANGUAGE_CODE], [other_lang], ['hi'], False])
+    # AUTO_SET_LANG: the contact language is the one of the last keyword
+    assert_equal(harness.contact.language, settings.LANGUAGE_CODE)
+    assert_equal(HelloHandler.test_many(['harness'], language=other_lang),
+                 [[settings.LANGUAGE_CODE]])
+
+
+def test_exit_handle():
+
+    from .handlers.keyword import KeywordHandler
+    from .handlers.callback import CallbackHandler
+    from .exceptions import ExitHandle
+    from .testing import Harness
+
+    class ExitHandler(KeywordHandler):
+        keyword = "exit"
+
+        def help(self, keyword, lang_code):
+            raise ExitHandle(u'bye')
+
+        def handle(self, text, keyword, lang_code):
+            raise ExitHandle(u'next', carry_on=True)
+
+    class ExitCallbackHandler(CallbackHandler):
+
+        @classmethod
+        def match(cls, msg):
+            if msg.text == u'carry on':
+                raise ExitHandle(carry_on=True)
+            return msg.text == u'stop'
+
+        def handle(self, match):
+            raise ExitHandle(u'stopped')
+
+    # the message is accepted unless carry_on is set
+    assert_equal(Harness(ExitHandler).test_many([u'exit', u'exit now']),
+                 [[u'bye'], False])
+    assert_equal(Harness(ExitCallbackHandler).test_many([u'stop', u'carry on',
+                                                         u'other']),
+                 [[u'stopped'], False, False])
+
+
+def test_handle_async():
+
+    try:
+        import trollius as asyncio
+        from trollius import From, Return
+    except ImportError:
+        raise SkipTest("trollius is not installed")
+
+    from django.utils import translation
+    from .handlers.keyword import KeywordHandler
+    from .handlers.callback import CallbackHandler
+    from .exceptions import ExitHandle
+    from .testing import FakeConnection, FakeContact
+    from rapidsms.messages import IncomingMessage
+
+    other_lang = settings.LANGUAGES[-1][0]
+
+    @asyncio.coroutine
+    def active_language(delay):
+        yield From(asyncio.sleep(delay))
+        raise Return(translation.get_language())
+
+    class SlowHandler(KeywordHandler):
+        keyword = "slow"
+        aliases = ((other_lang, ('sslow',)),)
+
+        @asyncio.coroutine
+        def handle(self, text, keyword, lang_code):
+            # the language is kept in nested coroutines
+            language = yield From(active_language(float(text)))
+            self.respond(language)
+
+        def help(self, keyword, lang_code):
+            raise ExitHandle(u'next', carry_on=True)
+
+    class EchoHandler(CallbackHandler):
+
+        @classmethod
+        @asyncio.coroutine
+        def match(cls, msg):
+            yield From(asyncio.sleep(0))
+            if msg.text == u'carry on':
+                raise ExitHandle(carry_on=True)
+            raise Return(msg.text.startswith(u'echo') or msg.text == u'slow')
+
+        def handle(self, match):
+            raise ExitHandle(self.msg.text)
+
+    app = _make_app([SlowHandler, EchoHandler])
+    connections = [FakeConnection(str(i)) for i in xrange(5)]
+    messages = [IncomingMessage(connection=connection, text=text)
+                for connection, text in zip(connections, [u'slow 0.02',
+                                                          u'sslow 0.01',
+                                                          u'echo',
+                                                          u'slow',
+                                                          u'carry on'])]
+
+    django_lang_bak = translation.get_language()
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(asyncio.gather(
+                  *[app.handle_async(msg) for msg in messages]))
+    assert_equal(translation.get_language(), django_lang_bak)
+
+    assert_equal([bool(accepted) for accepted in results],
+                 [True, True, True, True, False])
+    assert_equal([[response.text for response in msg.responses]
+                  for msg in messages],
+                 [[settings.LANGUAGE_CODE], [other_lang], [u'echo'],
+                  [u'next', u'slow'], []])
+
+    # the contact is not changed while another message from it is handled
+    contact = FakeContact(language=settings.LANGUAGE_CODE)
+    connections = [FakeConnection(str(i), contact=contact) for i in xrange(2)]
+    messages = [IncomingMessage(connection=connection, text=text)
+                for connection, text in zip(connections, [u'sslow 0.01',
+                                                          u'slow 0.02'])]
+    loop.run_until_complete(asyncio.gather(
+        *[app.handle_async(msg) for msg in messages]))
+    assert_equal(contact.language, settings.LANGUAGE_CODE)
+    assert_equal([[response.text for response in msg.responses]
+                  for msg in messages],
+                 [[other_lang], [settings.LANGUAGE_CODE]])
+
+
+def test_handler_scheduler():
+
+    from .handlers.base import BaseHandler
+    from .scheduler import HandlerScheduler, order_handlers
+
+    def handler(name, **attrs):
+        return type(name, (BaseHandler,), attrs)
+
+    rare = handler('RareHandler')
+    frequent = handler('FrequentHandler')
+    catch_all = handler('CatchAllHandler', after=('FrequentHandler',))
+    first = handler('FirstHandler', priority=1)
+
+    assert_equal(order_handlers([rare, catch_all, frequent, first]),
+                 [first, rare, frequent, catch_all])
+    assert_raises(ValueError, order_handlers,
+                  [handler('AHandler', after=('BHandler',)),
+                   handler('BHandler', after=('AHandler',))])
+
+    scheduler = HandlerScheduler([rare, catch_all, frequent, first],
+                                 interval=10)
+    for i in xrange(5):
+        scheduler.record(first, False)
+        scheduler.record(frequent, True)
+    assert_equal(scheduler.handlers, [first, frequent, rare, catch_all])
+
+
+def test_dispatch_pool():
+
+    import time
+    from .pool import DispatchPool, connection_key
+    from .testing import FakeConnection
+
+    class FakeApp(object):
+
+        def __init__(self):
+            self.handled = []
+
+        def handle(self, msg):
+            time.sleep(0.001)
+            if msg.text == 'error':
+                raise ValueError(msg.text)
+            self.handled.append((msg.connection.identity, msg.text))
+            return True
+
+    class Msg(object):
+        def __init__(self, connection, text):
+            self.connection = connection
+            self.text = text
+
+    connections = [FakeConnection(str(i)) for i in xrange(3)]
+    assert_equal(connection_key(Msg(connections[0], '')),
+                 (connections[0].backend.pk, '0'))
+    assert connection_key(Msg(FakeConnection('0'), '')) != \
+           connection_key(Msg(connections[0], ''))
+
+    app = FakeApp()
+    pool = DispatchPool(app, 3)
+    # errors are logged, the worker goes on
+    pool.submit(Msg(connections[0], 'error'))
+    results = []
+    for i in xrange(30):
+        pool.submit(Msg(connections[i % 3], str(i)),
+                    lambda msg, accepted: results.append(accepted))
+    pool.join()
+    pool.stop()
+
+    assert_equal(results, [True] * 30)
+    for connection in connections:
+        assert_equal([text for identity, text in app.handled
+                      if identity == connection.identity],
+                     map(str, range(int(connection.identity), 30, 3)))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Keyword lookup for keywords of several words, and for other separators
+    than spaces between the keyword and the data.
+"""
+
+
+WHITESPACE = u' \t\n\r\x0b\x0c\xa0'
+
+
+class KeywordTrie(object):
+    """
+        Find the longest keyword at the start of a text, in one scan of the
+        text, the keyword being followed by a separator or the end of the
+        text::
+
+            >>> trie = KeywordTrie(['stock', 'stock out'], u',#')
+            >>> trie.match(u'Stock out, 3 boxes')
+            ('stock out', u'3 boxes')
+            >>> trie.match(u'stock#3')
+            ('stock', u'3')
+
+        Whitespace always separates words. Inside a keyword, any run of
+        separators matches the spaces between its words. Keywords must be
+        cleaned (lowercase, stripped).
+    """
+
+    def __init__(self, keywords, separators=u''):
+        self.separators = frozenset(WHITESPACE + separators)
+        # nested dicts of characters, None is mapped to the keyword ending
+        # at this node
+        self.root = {}
+        for keyword in keywords:
+            node = self.root
+            for char in u' '.join(keyword.split()):
+                node = node.setdefault(char, {})
+            node.setdefault(None, keyword)
+
+
+    def match(self, text):
+        """
+            Return a tuple (keyword, remaining text or None) for the longest
+            keyword at the start of the text, or None.
+        """
+
+        separators = self.separators
+        length = len(text)
+        i = 0
+        while i < length and text[i] in separators:
+            i += 1
+
+        node = self.root
+        best = None
+        while i < length:
+            char = text[i]
+            if char in separators:
+                # a keyword may end here, or go on with its next word
+                if None in node:
+                    best = (node[None], i)
+                node = node.get(u' ')
+                if node is None:
+                    break
+                while i < length and text[i] in separators:
+                    i += 1
+                continue
+            node = node.get(char.lower())
+            if node is None:
+                break
+            i += 1
+        else:
+            if None in node:
+                best = (node[None], length)
+
+        if best is None:
+            return None
+
+        keyword, end = best
+        while end < length and text[end] in separators:
+            end += 1
+        return keyword, text[end:] or None
@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
+import os
+import sys
+import json
+import inspect
+import tempfile
+import threading
+
 from django.conf import settings
 from django.utils.translation import ugettext as _
-from settings import INSTALLED_HANDLERS, EXCLUDED_HANDLERS
+from settings import INSTALLED_HANDLERS, EXCLUDED_HANDLERS, HANDLERS_MANIFEST
 
 from rapidsms.utils.modules import find_python_files, get_class, try_import
 
@@ -13,6 +20,7 @@ from .exceptions import ExitHandle
 
 INSTALLED_HANDLERS = getattr(settings, 'INSTALLED_HANDLERS', INSTALLED_HANDLERS)
 EXCLUDED_HANDLERS = getattr(settings, 'EXCLUDED_HANDLERS', EXCLUDED_HANDLERS)
+HANDLERS_MANIFEST = getattr(settings, 'HANDLERS_MANIFEST', HANDLERS_MANIFEST)
 
 
 def get_handlers():
@@ -21,15 +29,240 @@ def get_handlers():
     defaults to **all** of the handlers defined in the current project,
     but can be explicitly specified by the ``INSTALLED_HANDLERS`` and
     ``EXCLUDED_HANDLERS`` settings. (Both lists of module prefixes.)
+
+    If ``HANDLERS_MANIFEST`` is set, the handlers found are saved in this
+    file and only the apps which handlers files changed are scanned again.
     """
+
+    manifest = getattr(settings, 'HANDLERS_MANIFEST', HANDLERS_MANIFEST)
+
+    if manifest:
+        app_names = _apps()
+        apps = _load_manifest(app_names, manifest)['apps']
+        names = [name for module_name in app_names
+                      for name in apps[module_name]['handlers']]
+        return [_load_handler(name) for name in _filter_handlers(names)]
+
+    handlers = _find_handlers(_apps())
+    get_fqdn = lambda x: '.'.join((x.__module__, x.__name__))
+    names = set(_filter_handlers(get_fqdn(h) for h in handlers))
+    return [h for h in handlers if get_fqdn(h) in names]
+
+
+def get_lazy_handlers():
+    """
+    Same as get_handlers(), but keyword handlers are not imported. They
+    are returned as a list of tuples (LazyHandler, keywords), keywords 
+    being the mapping returned by KeywordHandler.indexed_keywords(), read
+    from ``HANDLERS_MANIFEST``.
     
-    handlers = INSTALLED_HANDLERS or _find_handlers(_apps())
+    Return a tuple (handlers, keyword_handlers).
+    """
 
-    if EXCLUDED_HANDLERS:
-        get_fqdn = lambda x: '.'.join((x.__module__, x.__name__))
-        handlers = [h for h in handlers if get_fqdn(h) not in EXCLUDED_HANDLERS]
+    manifest = getattr(settings, 'HANDLERS_MANIFEST', HANDLERS_MANIFEST)
+    if not manifest:
+        raise ValueError(u"Lazy handlers loading requires "\
+                         u"settings.HANDLERS_MANIFEST.")
 
-    return handlers
+    handlers = []
+    keyword_handlers = []
+
+    app_names = _apps()
+    apps = _load_manifest(app_names, manifest)['apps']
+    keywords = {}
+    names = []
+    for module_name in app_names:
+        keywords.update(apps[module_name]['keywords'])
+        names.extend(apps[module_name]['handlers'])
+
+    for name in _filter_handlers(names):
+        if name in keywords:
+            keyword_handlers.append((LazyHandler(name), keywords[name]))
+        else:
+            handlers.append(_load_handler(name))
+
+    return handlers, keyword_handlers
+
+
+class LazyHandler(object):
+    """
+    Stand-in for a handler class which module is imported the first time
+    one of its attributes is used. Loading is thread safe and happens only
+    once.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.__name__ = name.rsplit('.', 1)[1]
+        self._handler = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        handler = self._handler
+        if handler is None:
+            with self._lock:
+                if self._handler is None:
+                    self._handler = _load_handler(self.name)
+                handler = self._handler
+        return handler
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
+def _filter_handlers(names):
+    """
+    Return the handlers full names matching ``INSTALLED_HANDLERS`` and not
+    matching ``EXCLUDED_HANDLERS``.
+    """
+
+    installed = getattr(settings, 'INSTALLED_HANDLERS', INSTALLED_HANDLERS)
+    excluded = getattr(settings, 'EXCLUDED_HANDLERS', EXCLUDED_HANDLERS)
+
+    if installed:
+        installed = set(installed)
+        names = [name for name in names if _match_prefix(name, installed)]
+
+    if excluded:
+        excluded = set(excluded)
+        names = [name for name in names if not _match_prefix(name, excluded)]
+
+    return names
+
+
+def _match_prefix(name, prefixes):
+    """
+    Return True if one of the module prefixes in the set ``prefixes`` 
+    matches the handler full name ``name``.
+    """
+
+    parts = name.split('.')
+    for i in xrange(1, len(parts) + 1):
+        if '.'.join(parts[:i]) in prefixes:
+            return True
+    return False
+
+
+def _load_manifest(app_names, path):
+    """
+    Return the manifest of the handlers defined in ``app_names``, saved in
+    ``path``. For each app, it contains the modification times of its 
+    handlers files and of the modules its handlers inherit from, the full
+    names of its handlers and the keywords of its keyword handlers. Apps
+    which files did not change are not scanned again. The manifest is
+    saved again if needed.
+    """
+
+    # models can't be loaded until the django ORM is ready.
+    from .handlers.keyword import KeywordHandler
+
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+
+    # keywords depend on the default language
+    if manifest.get('language_code') != settings.LANGUAGE_CODE:
+        manifest = {}
+    apps = manifest.get('apps', {})
+
+    updated = {'language_code': settings.LANGUAGE_CODE, 'apps': {}}
+
+    for module_name in app_names:
+        mtimes = _handlers_mtimes(module_name)
+        entry = apps.get(module_name)
+
+        # keywords may be inherited from a base class in another module
+        if entry is None or entry['mtimes'] != mtimes or \
+           entry.get('dependencies') is None or \
+           any(_mtime(dependency) != mtime
+               for dependency, mtime in entry['dependencies'].iteritems()):
+            found = _handlers(module_name) if mtimes is not None else []
+            entry = {
+                'mtimes': mtimes,
+                'dependencies': _dependencies_mtimes(found),
+                'handlers': ['.'.join((h.__module__, h.__name__)) 
+                             for h in found],
+                'keywords': dict(('.'.join((h.__module__, h.__name__)),
+                                  h.indexed_keywords()) 
+                                 for h in found 
+                                 if issubclass(h, KeywordHandler) and 
+                                    h.indexable())
+            }
+
+        updated['apps'][module_name] = entry
+
+    if updated != manifest:
+        # several processes may save it at once: each writes its own
+        # temporary file, and renaming it is atomic
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(updated, f)
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    return updated
+
+
+def _handlers_mtimes(module_name):
+    """
+    Return a dict of the modification times of the files in the 
+    ``handlers`` directory of ``module_name``, or None if there is no such
+    directory.
+    """
+
+    module = try_import(module_name)
+    if module is None or not hasattr(module, "__path__"):
+        return None
+
+    path = os.path.join(module.__path__[0], "handlers")
+    if not os.path.isdir(path):
+        return None
+
+    return dict((name, os.path.getmtime(os.path.join(path, name)))
+                for name in os.listdir(path) if name.endswith(".py"))
+
+
+def _dependencies_mtimes(handlers):
+    """
+    Return a dict of the modification times of the source files of the
+    modules which define the base classes of ``handlers``.
+    """
+
+    paths = set()
+    for handler in handlers:
+        for cls in inspect.getmro(handler)[1:]:
+            path = getattr(sys.modules.get(cls.__module__), '__file__', None)
+            if path is not None:
+                paths.add(os.path.splitext(path)[0] + '.py')
+
+    return dict((path, _mtime(path)) for path in paths)
+
+
+def _mtime(path):
+    """
+    Return the modification time of the file ``path``, or None if it does
+    not exist.
+    """
+
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _load_handler(name):
+    """
+    Import and return the handler which full name is ``name``.
+    """
+
+    module_name, class_name = name.rsplit('.', 1)
+    return getattr(try_import(module_name), class_name)
 
 
 def _find_handlers(app_names):